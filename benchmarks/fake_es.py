@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+LOGGER = logging.getLogger(__name__)
+
+VERSION_INFO = {
+    'name': 'scan2elk-bench',
+    'cluster_name': 'scan2elk-bench',
+    'version': {'number': '7.10.2', 'build_flavor': 'default', 'lucene_version': '8.7.0'},
+    'tagline': 'You Know, for Search',
+}
+
+
+class BenchStats:
+    """Counters of the stand-in server, shared by all request threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.indices = {}
+        self.bulk_requests = 0
+        self.bulk_docs = 0
+        self.bulk_bytes = 0
+        self.bulk_wire_bytes = 0
+        self.bulk_time = 0.0
+        self.first_bulk = None
+        self.last_bulk = None
+        self.requests = {}
+
+    def count_request(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def add_bulk(self, docs_per_index, raw_bytes, wire_bytes, duration):
+        now = time.time()
+        with self._lock:
+            self.bulk_requests += 1
+            self.bulk_bytes += raw_bytes
+            self.bulk_wire_bytes += wire_bytes
+            self.bulk_time += duration
+            if self.first_bulk is None:
+                self.first_bulk = now
+            self.last_bulk = now
+            for index, docs in docs_per_index.items():
+                self.bulk_docs += docs
+                self.indices[index] = self.indices.get(index, 0) + docs
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'bulk_requests': self.bulk_requests,
+                'bulk_docs': self.bulk_docs,
+                'bulk_bytes': self.bulk_bytes,
+                'bulk_wire_bytes': self.bulk_wire_bytes,
+                'bulk_time': self.bulk_time,
+                'first_bulk': self.first_bulk,
+                'last_bulk': self.last_bulk,
+                'requests': dict(self.requests),
+                'indices': dict(self.indices),
+            }
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """Implements just enough of the elasticsearch REST API for scan2elk: index create/delete, bulk and refresh"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format % args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.end_headers()
+        if 'HEAD' != self.command:
+            self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        wire_body = self.rfile.read(length) if length else b''
+        body = wire_body
+        if 'gzip' == self.headers.get('Content-Encoding'):
+            body = gzip.decompress(wire_body)
+        return body, len(wire_body)
+
+    def _route(self):
+        path = urlsplit(self.path).path
+        parts = [part for part in path.split('/') if part]
+        body, wire_bytes = self._read_body()
+        stats = self.server.stats
+        indices = self.server.indices
+
+        if not parts:
+            stats.count_request('info')
+            return self._send_json(VERSION_INFO)
+
+        endpoint = next((part for part in parts if part.startswith('_')), None)
+        index_names = parts[0].split(',') if not parts[0].startswith('_') else []
+        stats.count_request('{} {}'.format(self.command, endpoint or 'index'))
+
+        if '_bulk' == endpoint:
+            return self._bulk(body, wire_bytes, index_names[0] if index_names else None)
+        elif endpoint is None:
+            if 'HEAD' == self.command:
+                status = 200 if all(index in indices for index in index_names) else 404
+                return self._send_json({}, status)
+            elif 'PUT' == self.command:
+                indices.update({index: 0 for index in index_names})
+                return self._send_json({'acknowledged': True, 'shards_acknowledged': True, 'index': parts[0]})
+            elif 'DELETE' == self.command:
+                if not any(index in indices for index in index_names):
+                    return self._send_json({'error': 'index_not_found_exception', 'status': 404}, 404)
+                for index in index_names:
+                    indices.pop(index, None)
+                return self._send_json({'acknowledged': True})
+            elif 'GET' == self.command:
+                return self._send_json({index: {'aliases': {}, 'mappings': {'properties': {}}, 'settings': {}}
+                                        for index in indices})
+        elif '_settings' == endpoint and 'GET' == self.command:
+            return self._send_json({index: {'settings': {}} for index in index_names if index in indices})
+        elif '_count' == endpoint:
+            return self._send_json({'count': sum(indices.get(index, 0) for index in index_names)})
+        elif '_delete_by_query' == endpoint:
+            return self._send_json({'deleted': 0, 'failures': []})
+        elif endpoint in ('_alias', '_aliases', '_mapping') and 'GET' == self.command:
+            return self._send_json({})
+
+        # _refresh, _forcemerge, _index_template, PUT _settings, _aliases, ...
+        return self._send_json({'acknowledged': True, '_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+
+    def _bulk(self, body, wire_bytes, default_index):
+        start = time.time()
+        items = []
+        docs_per_index = {}
+        lines = iter(body.splitlines())
+        for line in lines:
+            if not line.strip():
+                continue
+            action = json.loads(line)
+            op_type, meta = next(iter(action.items()))
+            if 'delete' != op_type:
+                next(lines, None)
+            index = meta.get('_index', default_index)
+            docs_per_index[index] = docs_per_index.get(index, 0) + 1
+            items.append({op_type: {'_index': index, '_type': '_doc', '_id': meta.get('_id'), 'status': 201,
+                                    'result': 'created'}})
+        with self.server.lock:
+            for index, docs in docs_per_index.items():
+                self.server.indices[index] = self.server.indices.get(index, 0) + docs
+        self.server.stats.add_bulk(docs_per_index, len(body), wire_bytes, time.time() - start)
+
+        return self._send_json({'took': 1, 'errors': False, 'items': items})
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _route
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, FakeElasticsearchHandler)
+        self.stats = BenchStats()
+        # index name -> number of docs
+        self.indices = {}
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-es', daemon=True)
+        thread.start()
+        return thread
+
+
+if '__main__' == __name__:
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description='Stand-in elasticsearch server for benchmarks')
+    arg_parser.add_argument('-port', type=int, default=9299, help='Port to listen on. Default: 9299')
+    args = arg_parser.parse_args()
+
+    server = FakeElasticsearch(('127.0.0.1', args.port))
+    LOGGER.info('Listening on 127.0.0.1:{}'.format(server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        LOGGER.info(json.dumps(server.stats.to_dict(), indent=2))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import argparse
+import ipaddress
+import json
+import logging
+import os
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+LOGGER = logging.getLogger(__name__)
+
+SERVICES = (
+    (21, 'ftp'), (22, 'ssh'), (25, 'smtp'), (53, 'dns'), (80, 'www'), (110, 'pop3'), (143, 'imap'), (443, 'www'),
+    (445, 'cifs'), (993, 'imap'), (995, 'pop3'), (3306, 'mysql'), (3389, 'msrdp'), (5432, 'postgresql'),
+    (8080, 'www'), (8443, 'www'),
+)
+SEVERITIES = ('None', 'Low', 'Medium', 'High', 'Critical')
+TESTSSL_IDS = ('SSLv2', 'SSLv3', 'TLS1', 'TLS1_1', 'TLS1_2', 'TLS1_3', 'heartbleed', 'CCS', 'ROBOT', 'BREACH',
+               'POODLE_SSL', 'SWEET32', 'FREAK', 'DROWN', 'LOGJAM', 'BEAST', 'LUCKY13', 'RC4', 'cert_commonName',
+               'cert_notAfter', 'cipher_order', 'HSTS')
+
+
+class ScanGenerator:
+    """Write synthetic Nessus v2, Nmap XML and testssl JSON files of a configurable size"""
+
+    def __init__(self, hosts=100, ports=5, findings=20, output_size=512, files=1, seed=1):
+        self.hosts = hosts
+        self.ports = min(ports, len(SERVICES))
+        self.findings = findings
+        self.output_size = output_size
+        self.files = max(1, files)
+        self.random = random.Random(seed)
+        network = ipaddress.ip_network('10.0.0.0/8')
+        self.ips = [str(network[i + 1]) for i in range(hosts)]
+
+    def _text(self, size):
+        words = ('port', 'service', 'version', 'detected', 'remote', 'host', 'banner', 'protocol', 'cipher', 'tls')
+        text = []
+        length = 0
+        while length < size:
+            word = self.random.choice(words)
+            text.append(word)
+            length += len(word) + 1
+        return ' '.join(text)
+
+    def _host_chunks(self):
+        # distribute the hosts across the files
+        chunk_size = -(-len(self.ips) // self.files)
+        return [self.ips[i:i + chunk_size] for i in range(0, len(self.ips), chunk_size)]
+
+    def _ports(self, ip):
+        rnd = random.Random(ip)
+        return rnd.sample(SERVICES, self.ports)
+
+    def write_nessus(self, out_dir):
+        paths = []
+        for num, ips in enumerate(self._host_chunks()):
+            path = os.path.join(out_dir, 'bench_{}.nessus'.format(num))
+            with open(path, 'w') as out:
+                out.write('<?xml version="1.0" ?>\n<NessusClientData_v2>\n<Policy><policyName>bench</policyName>'
+                          '<Preferences><ServerPreferences><preference><name>TARGET</name><value>{}</value>'
+                          '</preference></ServerPreferences></Preferences></Policy>\n'
+                          '<Report name="bench" xmlns:cm="http://www.nessus.org/cm">\n'.format(','.join(ips)))
+                for ip in ips:
+                    out.write(self._nessus_host(ip))
+                out.write('</Report>\n</NessusClientData_v2>\n')
+            paths.append(path)
+        return paths
+
+    def _nessus_host(self, ip):
+        parts = ['<ReportHost name="{0}"><HostProperties><tag name="HOST_END">Thu Jan  2 10:00:00 2020</tag>'
+                 '<tag name="host-ip">{0}</tag><tag name="host-fqdn">host-{1}.bench.local</tag>'
+                 '<tag name="operating-system">Linux Kernel 4.15</tag>'
+                 '<tag name="HOST_START">Thu Jan  2 09:00:00 2020</tag></HostProperties>\n'
+                 .format(ip, ip.replace('.', '-'))]
+        ports = self._ports(ip)
+        for num in range(self.findings):
+            port, svc_name = ports[num % len(ports)]
+            severity = self.random.randint(0, 4)
+            plugin_id = 10000 + num
+            parts.append(
+                '<ReportItem port="{port}" svc_name="{svc}" protocol="tcp" severity="{severity}" '
+                'pluginID="{plugin_id}" pluginName="Bench Plugin {plugin_id}" pluginFamily="General">'
+                '<description>{description}</description><fname>bench_{plugin_id}.nasl</fname>'
+                '<plugin_modification_date>2020/01/01</plugin_modification_date>'
+                '<plugin_name>Bench Plugin {plugin_id}</plugin_name>'
+                '<plugin_publication_date>2019/01/01</plugin_publication_date><plugin_type>remote</plugin_type>'
+                '<risk_factor>{risk}</risk_factor><script_version>1.0</script_version>'
+                '<solution>n/a</solution><synopsis>Synthetic finding</synopsis>'
+                '<plugin_output>{output}</plugin_output></ReportItem>\n'.format(
+                    port=port, svc=svc_name, severity=severity, plugin_id=plugin_id, risk=SEVERITIES[severity],
+                    description=escape(self._text(128)), output=escape(self._text(self.output_size))))
+        parts.append('</ReportHost>\n')
+        return ''.join(parts)
+
+    def write_nmap(self, out_dir):
+        paths = []
+        for num, ips in enumerate(self._host_chunks()):
+            path = os.path.join(out_dir, 'bench_nmap_{}.xml'.format(num))
+            with open(path, 'w') as out:
+                out.write('<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE nmaprun>\n'
+                          '<nmaprun scanner="nmap" args="nmap -sV -oX bench.xml" start="1577955600" '
+                          'startstr="Thu Jan  2 09:00:00 2020" version="7.80" xmloutputversion="1.04">\n'
+                          '<scaninfo type="syn" protocol="tcp" numservices="1000" services="1-1000"/>\n')
+                for ip in ips:
+                    out.write(self._nmap_host(ip))
+                out.write('<runstats><finished time="1577959200" timestr="Thu Jan  2 10:00:00 2020" '
+                          'elapsed="3600" exit="success"/><hosts up="{0}" down="0" total="{0}"/></runstats>\n'
+                          '</nmaprun>\n'.format(len(ips)))
+            paths.append(path)
+        return paths
+
+    def _nmap_host(self, ip):
+        parts = ['<host starttime="1577955600" endtime="1577959200"><status state="up" reason="syn-ack"/>'
+                 '<address addr="{0}" addrtype="ipv4"/><hostnames><hostname name="host-{1}.bench.local" '
+                 'type="PTR"/></hostnames><ports>'.format(ip, ip.replace('.', '-'))]
+        for port, svc_name in self._ports(ip):
+            parts.append('<port protocol="tcp" portid="{}"><state state="open" reason="syn-ack" reason_ttl="64"/>'
+                         '<service name="{}" product="Bench" version="1.0" method="probed" conf="10"/>'
+                         '<script id="banner" output={}/></port>'
+                         .format(port, svc_name, quoteattr(self._text(self.output_size))))
+        parts.append('</ports></host>\n')
+        return ''.join(parts)
+
+    def write_testssl(self, out_dir):
+        # testssl writes one file per target
+        paths = []
+        for ip in self.ips:
+            for port, _ in self._ports(ip):
+                path = os.path.join(out_dir, 'bench_testssl_{}_{}.json'.format(ip, port))
+                entries = []
+                for finding_id in TESTSSL_IDS:
+                    entries.append({
+                        'id': finding_id,
+                        'ip': 'host-{}.bench.local/{}'.format(ip.replace('.', '-'), ip),
+                        'port': str(port),
+                        'severity': self.random.choice(('OK', 'INFO', 'LOW', 'MEDIUM', 'HIGH')),
+                        'finding': self._text(min(self.output_size, 256)),
+                    })
+                with open(path, 'w') as out:
+                    json.dump(entries, out, indent=1)
+                paths.append(path)
+        return paths
+
+    def write(self, out_dir, tools=('nessus', 'nmap', 'testssl')):
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for tool in tools:
+            paths.extend(getattr(self, 'write_{}'.format(tool))(out_dir))
+        return paths
+
+
+def add_generator_arguments(arg_parser):
+    arg_parser.add_argument('-hosts', type=int, default=100, help='Number of hosts. Default: 100')
+    arg_parser.add_argument('-ports', type=int, default=5, help='Open ports per host (max. 16). Default: 5')
+    arg_parser.add_argument('-findings', type=int, default=20, help='Nessus findings per host. Default: 20')
+    arg_parser.add_argument('-output-size', type=int, default=512,
+                            help='Size of plugin/script output in bytes. Default: 512')
+    arg_parser.add_argument('-files', type=int, default=1,
+                            help='Number of Nessus and Nmap files the hosts are split into. Default: 1')
+    arg_parser.add_argument('-tools', nargs='+', default=['nessus', 'nmap', 'testssl'],
+                            choices=['nessus', 'nmap', 'testssl'], help='Tools to generate files for')
+    arg_parser.add_argument('-seed', type=int, default=1, help='Random seed. Default: 1')
+
+
+def generator_from_args(args):
+    return ScanGenerator(args.hosts, args.ports, args.findings, args.output_size, args.files, args.seed)
+
+
+if '__main__' == __name__:
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description='Generate synthetic scan results')
+    arg_parser.add_argument('-out', required=True, help='Output directory')
+    add_generator_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    written = generator_from_args(args).write(args.out, args.tools)
+    LOGGER.info('Wrote {} files to {}'.format(len(written), args.out))
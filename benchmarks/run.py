@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_es import FakeElasticsearch
+from benchmarks.generate import add_generator_arguments, generator_from_args
+
+LOGGER = logging.getLogger(__name__)
+
+ROOT_PATH = os.path.realpath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+
+def run_ingest(data_dir, work_dir, server, scan2elk_args):
+    # point scan2elk to the stand-in server, keep all config and cache files in the work dir
+    config_home = os.path.join(work_dir, 'config')
+    os.makedirs(config_home, exist_ok=True)
+    with open(os.path.join(config_home, 'db.yaml'), 'w') as db_config:
+        db_config.write('host: 127.0.0.1\nport: {}\n'.format(server.port))
+    env = {
+        **os.environ,
+        'XDG_CONFIG_HOME': config_home,
+        'XDG_CACHE_HOME': os.path.join(work_dir, 'cache'),
+        'HOME': work_dir,
+    }
+    cmd = [sys.executable, os.path.join(ROOT_PATH, 'scan2elk.py'), '-dir', data_dir, '-project', 'bench',
+           '-report', os.path.join(work_dir, 'report.json'), *scan2elk_args]
+    LOGGER.info('Running: {}'.format(' '.join(shlex.quote(c) for c in cmd)))
+
+    start = time.time()
+    with open(os.path.join(work_dir, 'scan2elk.log'), 'w') as log_file:
+        result = subprocess.run(cmd, env=env, cwd=ROOT_PATH, stdout=log_file, stderr=subprocess.STDOUT)
+    end = time.time()
+    if 0 != result.returncode:
+        LOGGER.error('scan2elk failed with exit code {}, see {}'.format(result.returncode, log_file.name))
+
+    return start, end
+
+
+def read_run_report(work_dir):
+    # stage timings measured by scan2elk itself
+    try:
+        with open(os.path.join(work_dir, 'report.json'), 'r') as report_file:
+            report = json.load(report_file)
+    except (OSError, ValueError):
+        return {}
+
+    return {stage: stats['seconds'] for stage, stats in report.get('stages', {}).items()}
+
+
+def summarize(stats, data_bytes, gen_time, start, end, label='', scan2elk_stages=None):
+    wall_time = end - start
+    first_bulk = stats['first_bulk'] or end
+    last_bulk = stats['last_bulk'] or end
+
+    return {
+        'label': label,
+        'timestamp': start,
+        'docs': stats['bulk_docs'],
+        'bulk_requests': stats['bulk_requests'],
+        'input_mb': data_bytes / 1024 / 1024,
+        'bulk_mb': stats['bulk_bytes'] / 1024 / 1024,
+        'wire_mb': stats['bulk_wire_bytes'] / 1024 / 1024,
+        'docs_per_sec': stats['bulk_docs'] / wall_time if wall_time else 0,
+        'input_mb_per_sec': data_bytes / 1024 / 1024 / wall_time if wall_time else 0,
+        'bulk_mb_per_sec': stats['bulk_bytes'] / 1024 / 1024 / wall_time if wall_time else 0,
+        # ru_maxrss is in kilobytes on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'stages': {
+            'generate': gen_time,
+            'until_first_bulk': first_bulk - start,
+            'bulk_writing': last_bulk - first_bulk,
+            'after_last_bulk': end - last_bulk,
+            'server_bulk_handling': stats['bulk_time'],
+            'total': wall_time,
+        },
+        'scan2elk_stages': scan2elk_stages or {},
+        'requests': stats['requests'],
+        'indices': stats['indices'],
+    }
+
+
+def print_summary(summary):
+    print('docs:            {docs} in {bulk_requests} bulk requests'.format(**summary))
+    print('input:           {input_mb:.1f} MB, {input_mb_per_sec:.2f} MB/s'.format(**summary))
+    print('bulk bodies:     {bulk_mb:.1f} MB ({wire_mb:.1f} MB on the wire), {bulk_mb_per_sec:.2f} MB/s'.format(
+        **summary))
+    print('throughput:      {docs_per_sec:.0f} docs/s'.format(**summary))
+    print('peak rss:        {peak_rss_mb:.1f} MB'.format(**summary))
+    for stage, duration in summary['stages'].items():
+        print('{:<16} {:.2f}s'.format(stage + ':', duration))
+    for stage, duration in sorted(summary['scan2elk_stages'].items()):
+        print('{:<16} {:.2f}s (scan2elk)'.format(stage + ':', duration))
+
+
+if '__main__' == __name__:
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description='Benchmark the scan2elk ingest pipeline against a stand-in '
+                                                     'elasticsearch server')
+    arg_parser.add_argument('-data', help='Use existing scan results instead of generating them')
+    arg_parser.add_argument('-keep', action='store_true', help='Keep generated files and logs')
+    arg_parser.add_argument('-label', default='', help='Label of this run in the json output')
+    arg_parser.add_argument('-json', help='Append the results as a json line to this file')
+    arg_parser.add_argument('-scan2elk-args', default='', help='Additional arguments for scan2elk.py, '
+                                                               'i.e. -scan2elk-args="-workers 4 -fast-ingest"')
+    add_generator_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='scan2elk-bench-')
+    data_dir = args.data
+    gen_time = 0.0
+    if not data_dir:
+        data_dir = os.path.join(work_dir, 'data')
+        gen_start = time.time()
+        generator_from_args(args).write(data_dir, args.tools)
+        gen_time = time.time() - gen_start
+    data_bytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(data_dir) for f in files)
+
+    server = FakeElasticsearch()
+    server.start()
+    try:
+        start, end = run_ingest(data_dir, work_dir, server, shlex.split(args.scan2elk_args))
+    finally:
+        server.shutdown()
+
+    summary = summarize(server.stats.to_dict(), data_bytes, gen_time, start, end, args.label,
+                        read_run_report(work_dir))
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'a') as json_file:
+            json_file.write(json.dumps(summary) + '\n')
+
+    if args.keep:
+        LOGGER.info('Kept files in: {}'.format(work_dir))
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -13,6 +13,7 @@ from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import Q
 
+from scan2elk.data_handler.data_handler import PROJECTS_INDEX, project_alias, project_index_re
 from scan2elk.templates.base import TplBase
 
 #logging.basicConfig(level=logging.INFO)
@@ -49,18 +50,32 @@ class Scan2ElkInteractive(cmd2.Cmd):
         return all_fields
 
     def refresh_indices_and_fields(self):
-        for index in self.es.indices.get('*').keys():
-            if not self.project_name or index.endswith('_{}'.format(self.project_name)):
-                self.existing_indices.add(index)
-
-        for mname, data in self.es.indices.get_mapping(','.join(self.existing_indices), pretty=True).items():
-            try:
-                self.existing_fields[mname]
-            except KeyError:
-                self.existing_fields[mname] = set()
-            for prop in data['mappings']['properties']:
-                self.existing_fields[mname].add(prop)
-                self.all_existing_fields.add(prop)
+        self.existing_indices = set()
+        self.existing_fields = {}
+        # registered projects resolve all their indices through one alias, older ones by name
+        patterns = [project_alias('*'), '*']
+        if self.project_name:
+            patterns = [project_alias(self.project_name), '*_{}'.format(self.project_name)]
+        # the pattern also matches other projects ending with "_{project}"
+        name_re = project_index_re(self.project_name or None)
+        indices = {}
+        for pattern in patterns:
+            indices = self.es.indices.get(pattern, ignore_unavailable=True, allow_no_indices=True,
+                                          filter_path='*.aliases,*.mappings.properties')
+            if indices:
+                break
+
+        for index, data in indices.items():
+            # indices of -versioned runs are searched through their aliases
+            names = [alias for alias in data.get('aliases', {}) if not alias.startswith(project_alias(''))]
+            for name in (names or [index]):
+                if self.project_name and not name_re.match(name):
+                    continue
+                self.existing_indices.add(name)
+                fields = self.existing_fields.setdefault(name, set())
+                for prop in data.get('mappings', {}).get('properties', {}):
+                    fields.add(prop)
+
     #
     # def postparsing_precmd(self, statement):
     #     if 'search' == statement.command:
@@ -69,7 +84,7 @@ class Scan2ElkInteractive(cmd2.Cmd):
 
     def onecmd(self, statement, *, add_to_history=True):
         if not self.project_name and statement.command not in\
-                ('setproject', 'showindices', 'setsilent', 'quit', 'exit'):
+                ('setproject', 'showprojects', 'showindices', 'setsilent', 'quit', 'exit'):
             self.poutput('You have to set a project first. Check "setproject" command')
             return False
 
@@ -81,6 +96,13 @@ class Scan2ElkInteractive(cmd2.Cmd):
         if not self.silent:
             self.poutput('Not silent any more')
 
+    # noinspection PyUnusedLocal
+    def do_showprojects(self, args):
+        res = self.es.search(index=PROJECTS_INDEX, body={'size': 10000, 'sort': ['_doc']}, ignore=[404])
+        projects = sorted(hit['_source']['project'] for hit in res.get('hits', {}).get('hits', []))
+        self.poutput('Got registered projects:')
+        self.poutput('\n'.join(projects))
+
     # noinspection PyUnusedLocal
     def do_showindices(self, args):
         self.poutput('Got available indices:')
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+
+from elasticsearch.exceptions import ConnectionError
+
+from scan2elk.data_handler.bulk_export import find_exports
+from scan2elk.data_handler.data_handler import DataHandler, alias_of, project_alias
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger('elasticsearch').setLevel(logging.ERROR)
+
+
+if '__main__' == __name__:
+
+    LOGGER = logging.getLogger(__name__)
+    arg_parser = argparse.ArgumentParser(description='Load the indices written by scan2elk.py -export-ndjson')
+    arg_parser.add_argument('-dir', action='store', required=True, help='Export directory')
+    arg_parser.add_argument('-parallel', action='store', type=int,
+                            help='Number of concurrent bulk requests. Default: bulk_in_flight of db.yaml')
+    arg_parser.add_argument('-index', action='store', nargs='+', default=[], help='Only load these indices')
+    arg_parser.add_argument('-forcemerge', action='store_true', help='Force merge the indices after loading')
+    arg_parser.add_argument('-debug', action='store_true', help='Set logging to debug')
+    args = arg_parser.parse_args()
+
+    if args.debug:
+        logging.getLogger('scan2elk').setLevel(logging.DEBUG)
+
+    if not os.path.isdir(args.dir):
+        LOGGER.error('Unknown directory "{}"'.format(args.dir))
+        exit(1)
+    exports = {index: files for index, files in find_exports(args.dir).items()
+               if not args.index or index in args.index}
+    if not exports:
+        LOGGER.error('No exported indices found')
+        exit(1)
+
+    handler = DataHandler(ignoremappings=True)
+    if args.parallel is not None:
+        handler.set_bulk_in_flight(args.parallel, args.parallel)
+    completed = False
+    # project -> indices, from the project aliases of the exported mappings
+    projects = {}
+    try:
+        for index, (mapping_path, bulk_path) in sorted(exports.items()):
+            if mapping_path is None:
+                LOGGER.error('Missing mapping file for index {}, skipping'.format(index))
+                continue
+            with open(mapping_path, 'r') as mapping_file:
+                body = json.load(mapping_file)
+            handler.import_index(index, body)
+            for alias in body.get('aliases', {}):
+                if alias.startswith(project_alias('')):
+                    projects.setdefault(alias[len(project_alias('')):], []).append(alias_of(index))
+        # refresh and replicas are restored once all files are loaded
+        handler.begin_ingest()
+        for index, (mapping_path, bulk_path) in sorted(exports.items()):
+            if mapping_path is not None and bulk_path is not None:
+                handler.load_bulk_file(index, bulk_path)
+        handler.flush()
+        completed = True
+        # listed by "showprojects" of interactive.py
+        for project, indices in sorted(projects.items()):
+            handler.register_project(project, indices)
+    except ConnectionError:
+        LOGGER.error('Unable to connect to elasticsearch')
+    finally:
+        # also after errors, the indices must not stay without refresh and replicas
+        try:
+            handler.end_ingest(args.forcemerge and completed)
+        except Exception:
+            LOGGER.exception('Unable to finish loading the indices')
+        handler.close()
+        handler.log_summary()
+
+    # the run failed if docs were dropped
+    if handler.failed_docs and not handler.dead_letter_path:
+        exit(1)
@@ -3,9 +3,15 @@
 import os
 import argparse
 import logging
+import multiprocessing
 import re
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import ConnectionError, TransportError
 
 from vulnscan_parser.parser.nessus.xml import NessusParserXML
 from vulnscan_parser.parser.testssl.json import TestsslParserJson
@@ -22,9 +28,19 @@ from scan2elk.data_handler.nmap import NmapHandler
 from scan2elk.data_handler.sslscan import SslscanHandler
 from scan2elk.data_handler.pem import PemHandler
 from scan2elk.data_handler.burp import BurpHandler
-from scan2elk.data_handler.data_handler import DataHandler
-
-from scan2elk.nessusapi import NessusAPI
+from scan2elk.data_handler.bulk_export import BULK_SUFFIXES, default_compression
+from scan2elk.data_handler.data_handler import DataHandler, alias_of, swap_aliases
+from scan2elk.data_handler.seen_set import BloomFilter, SeenHashSet
+
+from scan2elk.archives import ArchiveMember, is_archive, iter_archive_members
+from scan2elk.classifier import FileClassifier
+from scan2elk.discovery import FileDiscovery
+from scan2elk.doc_buffer import DocBuffer, RESULT_TYPES
+from scan2elk.manifest import FileManifest
+from scan2elk.metrics import METRICS
+from scan2elk.nessusapi import NessusAPI, default_cache_dir
+from scan2elk.nessus_stream import iter_nessus_docs, split_nessus_file, parse_nessus_shard
+from scan2elk.parse_worker import RESULT_ATTRIBUTES, parse_file
 
 __author__ = 'happyc0ding'
 __version__ = '0.2'
@@ -33,26 +49,206 @@ __status__ = 'Development'
 logging.basicConfig(level=logging.INFO)
 logging.getLogger('elasticsearch').setLevel(logging.ERROR)
 
+LOGGER = logging.getLogger(__name__)
+
 
 def process(elk_handler, parser):
     if parser.findings:
-        elk_handler.process_findings((finding.to_serializable_dict() for finding in parser.findings.values()))
+        elk_handler.process_findings(METRICS.timed_iter(
+            'serialize', (finding.to_serializable_dict() for finding in parser.findings.values())))
     if parser.certificates:
-        elk_handler.process_certificates((cert.to_serializable_dict() for cert in parser.certificates.values()))
+        elk_handler.process_certificates(METRICS.timed_iter(
+            'serialize', (cert.to_serializable_dict() for cert in parser.certificates.values())))
     if parser.ciphers:
-        elk_handler.process_ciphers((cipher.to_serializable_dict() for cipher in parser.ciphers.values()))
+        elk_handler.process_ciphers(METRICS.timed_iter(
+            'serialize', (cipher.to_serializable_dict() for cipher in parser.ciphers.values())))
     if parser.hosts:
-        elk_handler.process_hosts((host.to_serializable_dict() for host in parser.hosts.values()))
+        elk_handler.process_hosts(METRICS.timed_iter(
+            'serialize', (host.to_serializable_dict() for host in parser.hosts.values())))
     if parser.services:
-        elk_handler.process_services((service.to_serializable_dict() for service in parser.services.values()))
-    elk_handler.sanity_check()
+        elk_handler.process_services(METRICS.timed_iter(
+            'serialize', (service.to_serializable_dict() for service in parser.services.values())))
     # save memory, but keep hosts since they are unique across files
     parser.clear_all_but_hosts()
 
 
+class ToolIngest:
+    """Ingest of the result files of one tool. Files are added one by one, while discovery is still running"""
+
+    def __init__(self, tool, handler, parser, project, add_duplicates, manifest=None, executor=None,
+                 stream_nessus=False, shard_size=0, tmp_dir=None, max_pending_jobs=16):
+        self.tool = tool
+        self.handler = handler
+        self.parser = parser
+        self.project = project
+        self.add_duplicates = add_duplicates
+        self.manifest = manifest
+        self.executor = executor
+        self.stream_nessus = stream_nessus and 'nessus' == tool
+        self.shard_size = shard_size
+        # local copies of archive members
+        self.tmp_dir = tmp_dir
+        self.max_pending_jobs = max_pending_jobs
+
+        self.files = set()
+        # new or changed files (incremental ingest) and their fingerprints
+        self.file_fingerprints = {}
+        self.created_index = False
+        self.doc_buffer = None
+        # results of the workers are added in the order the files were submitted, (future, archive member or None)
+        self.jobs = deque()
+
+    def start(self, lazy_indices=False, fast_ingest=False):
+        if lazy_indices:
+            self.handler.lazy_indices = True
+        self.parser.add_duplicates = self.add_duplicates
+        # init indices
+        # index_type = finding, host, ...
+        for index_type in self.handler.index_types:
+            index = '{}_{}_{}'.format(index_type, self.tool, self.project)
+            mapping = getattr(self.handler, '{}_mapping'.format(index_type))
+            if self.manifest is not None:
+                self.created_index = self.handler.ensure_index(index_type, index, mapping) or self.created_index
+            else:
+                self.handler.create_index(index_type, index, mapping)
+        if fast_ingest:
+            self.handler.begin_ingest()
+        if self.manifest is not None:
+            self.handler.upsert = True
+        if self.stream_nessus or self.executor is not None:
+            self.doc_buffer = DocBuffer(self.handler)
+
+    def add_file(self, filepath):
+        # archive members are only valid during this call
+        member = filepath if isinstance(filepath, ArchiveMember) else None
+        filepath = str(filepath)
+        if filepath in self.files:
+            if member is not None:
+                # may have been copied for the classification
+                member.remove()
+            return
+        self.files.add(filepath)
+
+        if self.manifest is not None:
+            if member is not None:
+                # only copied if it has to be hashed, unchanged members are skipped without any extraction
+                state, fingerprint = self.manifest.check(self.project, filepath, partial(member.spool, self.tmp_dir),
+                                                         member.size, member.mtime)
+            else:
+                state, fingerprint = self.manifest.check(self.project, filepath)
+            # new indices (or deleted ones) -> everything has to be parsed again
+            if not self.created_index:
+                if FileManifest.UNCHANGED == state:
+                    LOGGER.debug('Skipping unchanged file: {}'.format(filepath))
+                    if member is not None:
+                        member.remove()
+                    return
+                if FileManifest.CHANGED == state:
+                    LOGGER.info('File changed, replacing its data: {}'.format(filepath))
+                    self.handler.delete_file_docs(filepath)
+            self.file_fingerprints[filepath] = fingerprint
+
+        if member is not None:
+            self._add_member(member)
+        elif self.stream_nessus:
+            LOGGER.info('Streaming nessus file: {}'.format(filepath))
+            for docs in iter_nessus_docs(filepath, self.add_duplicates):
+                self.doc_buffer.add(docs)
+        elif self.executor is not None:
+            # every worker runs its own parser, huge nessus files are split into shards of ReportHost elements
+            if 'nessus' == self.tool and self.shard_size and os.path.getsize(filepath) > self.shard_size:
+                header_end, ranges = split_nessus_file(filepath, self.shard_size)
+                LOGGER.info('Parsing {} in {} shards'.format(filepath, len(ranges)))
+                for start, end in ranges:
+                    self._submit(None, parse_nessus_shard, filepath, header_end, start, end, self.add_duplicates)
+            else:
+                self._submit(None, parse_file, self.tool, filepath, self.add_duplicates)
+        else:
+            results = self._result_count()
+            with METRICS.timer('parse', file=filepath):
+                self.parser.parse(filepath)
+            # hosts of earlier files are merged by the parser, only new ones are counted
+            METRICS.count(file=filepath, docs=self._result_count() - results)
+            # check if any of the results exceeds bulk size
+            if any(len(x) > self.handler.bulk_size for x in (self.parser.findings, self.parser.certificates,
+                                                             self.parser.ciphers, self.parser.hosts,
+                                                             self.parser.services)):
+                process(self.handler, self.parser)
+
+    def _result_count(self):
+        return sum(len(getattr(self.parser, attr)) for attr in RESULT_ATTRIBUTES.values())
+
+    def _add_member(self, member):
+        if self.stream_nessus and member.local_path is None:
+            # straight from the archive
+            LOGGER.info('Streaming nessus file: {}'.format(member))
+            for docs in iter_nessus_docs(member.fileobj, self.add_duplicates, member.path):
+                self.doc_buffer.add(docs)
+            return
+
+        # the parsers need a path, members are copied one at a time and removed after parsing
+        local_path = member.spool(self.tmp_dir)
+        if self.stream_nessus:
+            LOGGER.info('Streaming nessus file: {}'.format(member))
+            for docs in iter_nessus_docs(local_path, self.add_duplicates, member.path):
+                self.doc_buffer.add(docs)
+            member.remove()
+        elif self.executor is not None:
+            self._submit(member, parse_file, self.tool, local_path, self.add_duplicates, member.path)
+        else:
+            # a fresh parser, the docs are merged with the results of the shared parser by finish()
+            if self.doc_buffer is None:
+                self.doc_buffer = DocBuffer(self.handler)
+            self.doc_buffer.add(parse_file(self.tool, local_path, self.add_duplicates, member.path))
+            member.remove()
+
+    def _submit(self, member, func, *args):
+        self.jobs.append((self.executor.submit(func, *args), member))
+        # limit the results (and archive member copies) waiting in memory or on disk
+        while len(self.jobs) > self.max_pending_jobs:
+            self._collect_result()
+        self._collect_results(wait=False)
+
+    def _collect_result(self):
+        job, member = self.jobs.popleft()
+        try:
+            self.doc_buffer.add(job.result())
+        finally:
+            if member is not None:
+                member.remove()
+
+    def _collect_results(self, wait=True):
+        # keep the order of the files, like the serial path
+        while self.jobs and (wait or self.jobs[0][0].done()):
+            self._collect_result()
+
+    def finish(self):
+        # process remaining
+        serial = self.executor is None and not self.stream_nessus
+        if serial:
+            process(self.handler, self.parser)
+        if self.doc_buffer is not None:
+            self._collect_results()
+            if serial and self.parser.hosts:
+                # hosts are unique across files, merge them with the hosts of archive members
+                self.doc_buffer.add({'host': [host.to_serializable_dict() for host in self.parser.hosts.values()],
+                                     **{index_type: [] for index_type in RESULT_TYPES if 'host' != index_type}})
+            self.doc_buffer.finish()
+        # all data has to be written before the files are marked as done
+        self.handler.flush()
+        # once, the handler validates the docs it has seen
+        with METRICS.timer('sanity_check'):
+            self.handler.sanity_check()
+        if self.manifest is not None:
+            LOGGER.info('Incremental ingest: {} new or changed {} files'.format(len(self.file_fingerprints),
+                                                                                self.tool))
+            for filepath, fingerprint in self.file_fingerprints.items():
+                self.manifest.add(self.project, self.tool, filepath, fingerprint)
+            self.manifest.commit()
+
+
 if '__main__' == __name__:
 
-    LOGGER = logging.getLogger(__name__)
     LOGGER.setLevel(logging.DEBUG)
     IGNORED_FILE_EXTENSIONS = {
         'nmap',
@@ -69,6 +265,23 @@ if '__main__' == __name__:
     input_group = arg_parser.add_argument_group('Input')
     input_group.add_argument('-dir', action='store', nargs='+', help='Directories to parse')
     input_group.add_argument('-project', action='store', help='Project name')
+    input_group.add_argument('-incremental', action='store_true',
+                             help='Keep existing indices and only parse new or changed files')
+    input_group.add_argument('-manifest', action='store',
+                             default=os.path.join(os.path.expanduser('~'), '.local', 'share', 'scan2elk',
+                                                  'manifest.sqlite'),
+                             help='Manifest of ingested files used by -incremental. '
+                                  'Default: "~/.local/share/scan2elk/manifest.sqlite"')
+    input_group.add_argument('-include', action='store', nargs='+', default=[],
+                             help='Only parse files matching these gitignore-style globs, i.e. "nessus/" "**/*.xml"')
+    input_group.add_argument('-exclude', action='store', nargs='+', default=[],
+                             help='Skip files and directories matching these gitignore-style globs, i.e. "old/"')
+    input_group.add_argument('-max-depth', action='store', type=int,
+                             help='Maximum directory depth below -dir, 0 only parses the files in -dir')
+    input_group.add_argument('-discovery-threads', action='store', type=int, default=8,
+                             help='Number of threads scanning directories. Default: 8')
+    input_group.add_argument('-no-archives', action='store_true',
+                             help='Do not read .zip, .tar, .tar.gz and .tar.xz archives found in -dir')
     input_group.add_argument('-noduplicates', action='store_true', help='Do not save duplicate findings')
     input_group.add_argument('-ignore-file-ext', action='store', nargs='+', default=[],
                              help='List of file extensions to ignore (space or comma separated), i.e. "docx pdf ini"')
@@ -82,15 +295,64 @@ if '__main__' == __name__:
     nessus_group.add_argument('-nessususer', action='store', help='Nessus username')
     nessus_group.add_argument('-nessusscans', action='store', nargs='+',
                               help='Names of the nessus scans to process, i.e. "scan1 scan2"')
+    nessus_group.add_argument('-nessusdownloads', action='store', type=int, default=4,
+                              help='Number of exports downloaded at the same time. Default: 4')
+    nessus_group.add_argument('-nessuscache', action='store', default=default_cache_dir(),
+                              help='Directory of cached exports, unchanged scans are not exported again. '
+                                   'Default: ~/.cache/scan2elk/nessus')
+    nessus_group.add_argument('-nessusnocache', action='store_true', help='Always export and download the scans')
 
     del_group_base = arg_parser.add_argument_group('Delete')
     del_group = del_group_base.add_mutually_exclusive_group()
     del_group.add_argument('-delete', action='store', help='Project name to delete')
     del_group.add_argument('-deleteall', action='store_true', help='Delete all indices (projects)')
 
+    perf_group = arg_parser.add_argument_group('Performance')
+    perf_group.add_argument('-dead-letter', action='store',
+                            help='Append entries which cannot be inserted to this ndjson file, '
+                                 'without it the run fails if entries were dropped')
+    perf_group.add_argument('-dedupe', action='store_true',
+                            help='Do not send docs identical to ones already sent in this run')
+    perf_group.add_argument('-dedupe-fp-rate', action='store', type=float, default=0,
+                            help='Use a bloom filter with this false positive rate for -dedupe (false positives are '
+                                 'not sent). Default: 0 (exact, 16 bytes per doc)')
+    perf_group.add_argument('-dedupe-capacity', action='store', type=int, default=1000000,
+                            help='Expected number of docs for the -dedupe bloom filter. Default: 1000000')
+    perf_group.add_argument('-fast-ingest', action='store_true',
+                            help='Disable refresh and replicas while loading, restore them and refresh once at the end')
+    perf_group.add_argument('-forcemerge', action='store_true',
+                            help='Force merge the indices at the end of a -fast-ingest run')
+    perf_group.add_argument('-stream-nessus', action='store_true',
+                            help='Process .nessus files host by host with constant memory (for very large files)')
+    perf_group.add_argument('-lazy-indices', action='store_true',
+                            help='Only register index templates for tools with files, '
+                                 'indices are created on the first write')
+    perf_group.add_argument('-nessus-shard-mb', action='store', type=int, default=0,
+                            help='Split .nessus files larger than this (MB) into shards parsed by all -workers. '
+                                 'Default: 0 (disabled)')
+    perf_group.add_argument('-versioned', action='store_true',
+                            help='Write into new indices and switch the aliases of the project to them when the run '
+                                 'is finished, the current data stays searchable while loading')
+    perf_group.add_argument('-workers', action='store', type=int, default=1,
+                            help='Number of worker processes used for parsing files. Default: 1 (no extra processes)')
+
+    export_group = arg_parser.add_argument_group('Export')
+    export_group.add_argument('-export-ndjson', action='store', metavar='DIR',
+                              help='Write mappings and compressed bulk files per index to this directory instead of '
+                                   'sending them to elasticsearch, load them with replay.py')
+    export_group.add_argument('-export-compression', action='store', choices=sorted(BULK_SUFFIXES.keys()),
+                              default=default_compression(),
+                              help='Compression of the bulk files. Default: zstd if installed, otherwise gzip')
+
     debug_group = arg_parser.add_argument_group('Debug')
     debug_group.add_argument('-debug', action='store_true', help='Set logging to debug')
     debug_group.add_argument('-debugelk', action='store_true', help='Set elasticsearch logging to debug')
+    debug_group.add_argument('-report', action='store',
+                             help='Write a json report with timings and counters to this file')
+    debug_group.add_argument('-prometheus', action='store',
+                             help='Write ingest metrics to this file (textfile collector of the node exporter)')
+    debug_group.add_argument('-measure-transport', action='store_true',
+                             help='Report raw, gzip compressed and sent bytes of bulk requests per index')
 
     args = arg_parser.parse_args()
 
@@ -100,6 +362,8 @@ if '__main__' == __name__:
             if 'y' == answer.lower():
                 dh = DataHandler(ignoremappings=True)
                 dh.delete_indices(args.delete)
+                if os.path.isfile(args.manifest):
+                    FileManifest(args.manifest).delete_project(args.delete)
             else:
                 LOGGER.error('Cancelled')
         else:
@@ -107,6 +371,8 @@ if '__main__' == __name__:
             if 'y' == answer.lower():
                 dh = DataHandler(ignoremappings=True)
                 dh.delete_indices()
+                if os.path.isfile(args.manifest):
+                    FileManifest(args.manifest).delete_project()
             else:
                 LOGGER.error('Cancelled')
         exit(0)
@@ -144,6 +410,25 @@ if '__main__' == __name__:
         LOGGER.error('No special or uppercase chars in project name, please')
         exit(1)
 
+    if args.workers < 1:
+        LOGGER.error('-workers must be at least 1')
+        exit(1)
+
+    if args.versioned and args.incremental:
+        LOGGER.error('-incremental updates the existing indices and cannot be used with -versioned')
+        exit(1)
+    # suffix of the indices of a -versioned run
+    run_id = time.strftime('v%Y%m%d%H%M%S')
+
+    if args.export_ndjson:
+        if args.incremental:
+            LOGGER.error('-incremental needs the indexed data and cannot be used with -export-ndjson')
+            exit(1)
+        if 'zstd' == args.export_compression and 'zstd' != default_compression():
+            LOGGER.error('The zstandard module is required for -export-compression zstd')
+            exit(1)
+        os.makedirs(args.export_ndjson, exist_ok=True)
+
     parsers = {
         'nmap': NmapParserXML(),
         'nessus': NessusParserXML(),
@@ -166,64 +451,35 @@ if '__main__' == __name__:
         'burp': BurpHandler(),
     }
 
-    result_file_list = {k: set() for k in parsers.keys()}
-    if args.dir:
-        for arg_dir in args.dir:
-            directory = os.path.realpath(arg_dir)
-            # check if the directory exists
-            if not os.path.isdir(directory):
-                LOGGER.error('Unknown directory "{}"'.format(directory))
-                continue
-            # walk dir recursively
-            for root, dirs, files in os.walk(directory):
-                for the_file in files:
-                    file_ext = os.path.splitext(the_file)[1][1:]
-
-                    # check for ingnored files
-                    if file_ext.lower() in ignored_file_ext or\
-                            (included_file_ext and file_ext not in included_file_ext):
-                        continue
-
-                    full_path = os.path.realpath(os.path.join(root, the_file))
-                    if the_file.endswith('.nessus'):
-                        result_file_list['nessus'].add(full_path)
-                        continue
-                    elif the_file.endswith('.xml'):
-                        if 'sslyze' in the_file.lower():
-                            result_file_list['sslyze'].add(full_path)
-                            continue
-                        elif 'nmap' in the_file.lower():
-                            result_file_list['nmap'].add(full_path)
-                            continue
-                        elif 'sslscan' in the_file.lower():
-                            result_file_list['sslscan'].add(full_path)
-                        elif 'burp' in the_file.lower():
-                            result_file_list['burp'].add(full_path)
-                        # all except nikto
-                        elif the_file.startswith('nikto'):
-                            continue
-                    # TODO: sslyze json?
-                    elif the_file.endswith('.json'):
-                        result_file_list['testssl'].add(full_path)
-                        continue
-                    elif the_file.endswith('.pem'):
-                        result_file_list['pem'].add(full_path)
-                        continue
-
-                    # check if one of the parsers recognizes the file
-                    for pname, parser in parsers.items():
-                        if parser.is_valid_file(full_path):
-                            result_file_list[pname].add(full_path)
-                            break
-                    else:
-                        LOGGER.warning('Unknown file type: {}'.format(full_path))
-
-                    # elif the_file.endswith('.pem') or (the_file.startswith('openssl_') and the_file.endswith('.stdout')):
-                    #     result_file_list['pem'].add(full_path)
-                    #
-                    # elif 'result.sqlite' == the_file:
-                    #     result_file_list['sdc'].add(full_path)
+    classifier = FileClassifier()
 
+    def find_parser(file_path):
+        # check if one of the parsers recognizes the file
+        for pname, parser in parsers.items():
+            if parser.is_valid_file(file_path):
+                return pname
+        return None
+
+    seen_docs = None
+    if args.dedupe:
+        # one set for all handlers, the hashes include the index name
+        if args.dedupe_fp_rate > 0:
+            seen_docs = BloomFilter(args.dedupe_capacity, args.dedupe_fp_rate)
+        else:
+            seen_docs = SeenHashSet()
+    for handler in data_handlers.values():
+        handler.seen_docs = seen_docs
+        if args.dead_letter:
+            handler.dead_letter_path = args.dead_letter
+        handler.measure_transport = args.measure_transport
+        if args.export_ndjson:
+            handler.export_dir = args.export_ndjson
+            handler.export_compression = args.export_compression
+        if args.versioned:
+            handler.run_id = run_id
+        handler.project = project_name
+
+    METRICS.reset()
     nessus_api = None
     if args.nessusscans:
         if not args.nessususer:
@@ -231,44 +487,143 @@ if '__main__' == __name__:
             exit(1)
 
         host, port = args.nessusapi.split(':')
-        nessus_api = NessusAPI(host, port, args.nessususer)
-        nessus_api.download_exports(args.nessusscans)
-        result_file_list['nessus'] |= nessus_api.nessus_file_paths
-
-    # make sure we have at least one usable file
-    if not any(len(x) > 0 for x in result_file_list.values()):
-        LOGGER.error('No relevant files detected')
-        exit(1)
-
-    try:
-        for tool, handler in data_handlers.items():
-            parsers[tool].add_duplicates = add_duplicates
-            # init indices
-            # index_type = finding, host, ...
-            for index_type in handler.index_types:
-                index = '{}_{}_{}'.format(index_type, tool, project_name)
-                mapping = getattr(handler, '{}_mapping'.format(index_type))
-                # LOGGER.info('init index: {} {}'.format(index, mapping))
-                handler.create_index(index_type, index, mapping)
-            # parse files
-            for filepath in result_file_list[tool]:
-                parser = parsers[tool]
-                # sanity check
-                if not parser.is_valid_file(filepath):
-                    LOGGER.error('Invalid content in file {} for parser {}'.format(filepath, tool))
+        nessus_api = NessusAPI(host, port, args.nessususer, max_downloads=args.nessusdownloads,
+                               cache_dir=None if args.nessusnocache else args.nessuscache)
+
+    def accept_file(file_name):
+        file_ext = os.path.splitext(file_name)[1][1:]
+        # check for ingnored files
+        return not (file_ext.lower() in ignored_file_ext or (included_file_ext and file_ext not in included_file_ext))
+
+    def iter_archive(archive_path):
+        # reading and decompressing the archive
+        for member in METRICS.timed_iter('archive', iter_archive_members(archive_path, classifier.header_size),
+                                         file=archive_path):
+            if not accept_file(member.name) or is_archive(member.name):
+                continue
+            with METRICS.timer('classify', file=member.path):
+                tool = classifier.classify_header(member.read_header(classifier.header_size))
+            if tool is None:
+                local_path = member.spool(tmp_dir.name)
+                with METRICS.timer('classify', file=member.path):
+                    tool = find_parser(local_path)
+            if tool is None:
+                LOGGER.warning('Unknown file type: {}'.format(member))
+                member.remove()
+            else:
+                yield member, tool
+
+    def iter_result_files():
+        if nessus_api:
+            # ingest starts with the first finished download
+            for filepath in METRICS.timed_iter('download', nessus_api.iter_exports(args.nessusscans)):
+                yield filepath, 'nessus'
+        if args.dir:
+            discovery = FileDiscovery(args.include, args.exclude, args.max_depth, args.discovery_threads,
+                                      lambda file_name: accept_file(file_name) or
+                                      (not args.no_archives and is_archive(file_name)))
+            for full_path in METRICS.timed_iter('discovery', discovery.iter_files(args.dir)):
+                if not args.no_archives and is_archive(full_path):
+                    yield from iter_archive(full_path)
                     continue
+                # the file header decides, the parsers are only asked for unknown headers
+                with METRICS.timer('classify', file=full_path):
+                    tool = classifier.classify(full_path, fallback=find_parser)
+                if tool is None:
+                    LOGGER.warning('Unknown file type: {}'.format(full_path))
+                else:
+                    yield full_path, tool
+
+    manifest = None
+    if args.incremental:
+        manifest = FileManifest(args.manifest)
+
+    executor = None
+    if args.workers > 1:
+        # workers are started on the first submit, while discovery, bulk and download threads are running. a forked
+        # child could inherit a lock held by one of them (i.e. of logging), forkserver starts them from a clean process
+        executor = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('forkserver'))
+
+    # local copies of archive members
+    tmp_dir = tempfile.TemporaryDirectory(prefix='scan2elk-')
+    ingests = {tool: ToolIngest(tool, handler, parsers[tool], project_name, add_duplicates, manifest, executor,
+                                args.stream_nessus, args.nessus_shard_mb * 1024 * 1024, tmp_dir.name,
+                                args.workers * 4)
+               for tool, handler in data_handlers.items()}
+    started = set()
+    completed = False
+    try:
+        # files are parsed while discovery is still running
+        for filepath, tool in iter_result_files():
+            if tool not in started:
+                # without -lazy-indices all indices are (re)created, but only once there is a relevant file
+                for start_tool in ([tool] if args.lazy_indices else data_handlers.keys()):
+                    if start_tool not in started:
+                        ingests[start_tool].start(args.lazy_indices and not args.export_ndjson,
+                                                  args.fast_ingest and not args.export_ndjson)
+                        started.add(start_tool)
+            # sanity check, uses the cached verdicts from discovery (archive members are only read once)
+            if not isinstance(filepath, ArchiveMember) and not classifier.is_valid(filepath, tool):
+                LOGGER.error('Invalid content in file {} for parser {}'.format(filepath, tool))
+                continue
+            ingests[tool].add_file(filepath)
 
-                parser.parse(filepath)
-
-                # check if any of the results exceeds bulk size
-                if any(len(x) > handler.bulk_size for x in (parser.findings, parser.certificates, parser.ciphers,
-                                                            parser.hosts, parser.services)):
-                    process(handler, parser)
-            # process remaining
-            process(handler, parsers[tool])
+        # make sure we have at least one usable file
+        if not started:
+            LOGGER.error('No relevant files detected')
+            exit(1)
+        for tool in data_handlers.keys():
+            if tool in started:
+                ingests[tool].finish()
+        # a missing scan must not replace the previous data (-versioned) or pass unnoticed
+        completed = not (nessus_api and nessus_api.failed_scans)
     except ConnectionError:
         LOGGER.error('Unable to connect to elasticsearch')
+    finally:
+        if args.fast_ingest:
+            for handler in data_handlers.values():
+                # every handler, whatever went wrong before
+                try:
+                    handler.end_ingest(args.forcemerge and completed)
+                except Exception:
+                    LOGGER.exception('Unable to finish the ingest of {} indices'.format(handler.NAME))
+                    completed = False
+        if args.versioned:
+            if completed:
+                # one request for all tools, the project is never searched with a mix of old and new data
+                try:
+                    swap_aliases([data_handlers[tool] for tool in data_handlers.keys() if tool in started])
+                except TransportError as e:
+                    LOGGER.error('Unable to switch the aliases, they still point to the previous indices: '
+                                 '{}'.format(e))
+                    completed = False
+            elif started:
+                LOGGER.error('Run failed, the aliases still point to the previous indices')
+        if completed and not args.export_ndjson:
+            try:
+                data_handlers[next(iter(started))].register_project(
+                    project_name, [alias_of(index) for tool in started for index in
+                                   data_handlers[tool].index_names.values()])
+            except TransportError as e:
+                LOGGER.error('Unable to register project {}: {}'.format(project_name, e))
+        for handler in data_handlers.values():
+            handler.close()
+            handler.log_summary()
+        if args.report:
+            METRICS.write_report(args.report, project_name)
+        if args.prometheus:
+            METRICS.write_prometheus(args.prometheus, project_name)
+        if executor is not None:
+            executor.shutdown()
+        if manifest is not None:
+            manifest.close()
+        tmp_dir.cleanup()
 
     if nessus_api:
         # clean up temporary files
         nessus_api.close_tmp_files()
+
+    # the run failed if it was not completed or docs were dropped
+    if not completed or any(handler.failed_docs and not handler.dead_letter_path
+                            for handler in data_handlers.values()):
+        exit(1)
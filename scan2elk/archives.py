@@ -0,0 +1,79 @@
+import io
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from scan2elk.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2', '.tbz2')
+
+
+def is_archive(file_path):
+    return file_path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+class ArchiveMember:
+    """A regular file within a zip or tar archive
+
+    Members are read in archive order without extracting the archive, the file object of a member is only valid until
+    the next member is read. spool() writes a copy for parsers which need a path, remove() deletes it.
+    """
+
+    def __init__(self, archive_path, name, size, mtime, fileobj, header_size=8192):
+        self.archive_path = archive_path
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        # src_file of the docs
+        self.path = '{}!{}'.format(archive_path, name)
+        self.local_path = None
+        self.fileobj = io.BufferedReader(fileobj, buffer_size=max(header_size, io.DEFAULT_BUFFER_SIZE))
+
+    def __str__(self):
+        return self.path
+
+    def read_header(self, size):
+        # the header stays in the buffer, the member can still be read completely
+        return self.fileobj.peek(size)[:size]
+
+    def spool(self, tmp_dir):
+        if self.local_path is None:
+            # keep the file name, only the directory differs
+            self.local_path = os.path.join(tempfile.mkdtemp(dir=tmp_dir), os.path.basename(self.name))
+            with METRICS.timer('spool', file=self.path), open(self.local_path, 'wb') as local_file:
+                shutil.copyfileobj(self.fileobj, local_file, 1024 * 1024)
+        return self.local_path
+
+    def remove(self):
+        if self.local_path is not None:
+            shutil.rmtree(os.path.dirname(self.local_path), ignore_errors=True)
+            self.local_path = None
+
+
+def iter_archive_members(archive_path, header_size=8192):
+    """Yield the regular files of a zip or (compressed) tar archive as ArchiveMember objects, in archive order"""
+    try:
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    with archive.open(info) as member_file:
+                        yield ArchiveMember(archive_path, info.filename, info.file_size,
+                                            time.mktime(info.date_time + (0, 0, -1)), member_file, header_size)
+        else:
+            # stream mode, a compressed archive is decompressed exactly once
+            with tarfile.open(archive_path, 'r|*') as archive:
+                for info in archive:
+                    if not info.isfile():
+                        continue
+                    yield ArchiveMember(archive_path, info.name, info.size, info.mtime, archive.extractfile(info),
+                                        header_size)
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError):
+        LOGGER.exception('Cannot read archive: {}'.format(archive_path))
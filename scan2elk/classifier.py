@@ -0,0 +1,100 @@
+import logging
+import os
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FileClassifier:
+    """Detect the tool which created a result file by reading only the beginning of the file
+
+    Verdicts are cached per (path, mtime), so discovery and validation of a file need a single read.
+    """
+
+    HEADER_SIZE = 8192
+
+    # everything which may appear in front of the xml root element. the DOCTYPE may contain an internal subset with
+    # markup declarations (i.e. Burp: '<!DOCTYPE issues [<!ELEMENT issues (issue*)> ...]>'), quoted strings may
+    # contain ">" and "]"
+    XML_QUOTED = r'"[^"]*"|\'[^\']*\''
+    XML_PROLOG_RE = re.compile(r'\A(?:\s+|<\?.*?\?>|<!--.*?-->|<!DOCTYPE(?:[^\[>"\']|{0}|\[(?:[^\]"\']|{0})*\])*>)*'
+                               .format(XML_QUOTED), re.DOTALL)
+    XML_ROOT_RE = re.compile(r'<([A-Za-z_][\w.:-]*)([^>]*)')
+    JSON_KEY_RE = re.compile(r'"(\w+)"\s*:')
+
+    TESTSSL_FLAT_KEYS = {'id', 'severity', 'finding'}
+    TESTSSL_PRETTY_KEYS = {'Invocation', 'scanResult'}
+
+    def __init__(self, header_size=HEADER_SIZE):
+        self.header_size = header_size
+        self._cache = {}
+
+    def classify(self, file_path, fallback=None):
+        """Return the tool name for a file or None. fallback(file_path) is used if the header is not recognized"""
+        try:
+            key = (file_path, os.stat(file_path).st_mtime_ns)
+        except OSError:
+            LOGGER.exception('Cannot access file: {}'.format(file_path))
+            return None
+
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        try:
+            with open(file_path, 'rb') as header_file:
+                header = header_file.read(self.header_size)
+        except OSError:
+            LOGGER.exception('Cannot read file: {}'.format(file_path))
+            return None
+        tool = self.classify_header(header)
+        if tool is None and fallback is not None:
+            tool = fallback(file_path)
+        self._cache[key] = tool
+
+        return tool
+
+    def is_valid(self, file_path, tool):
+        return tool == self.classify(file_path)
+
+    def classify_header(self, header):
+        text = header.decode('utf-8', errors='replace').lstrip('\ufeff')
+        stripped = text.lstrip()
+
+        if stripped.startswith('-----BEGIN CERTIFICATE-----'):
+            return 'pem'
+        if stripped.startswith('<'):
+            return self._classify_xml(stripped)
+        if stripped.startswith('[') or stripped.startswith('{'):
+            return self._classify_json(stripped)
+
+        return None
+
+    def _classify_xml(self, text):
+        prolog = self.XML_PROLOG_RE.match(text)
+        root = self.XML_ROOT_RE.match(text, prolog.end())
+        if root is None:
+            return None
+
+        name, attributes = root.groups()
+        if 'NessusClientData_v2' == name:
+            return 'nessus'
+        elif 'nmaprun' == name:
+            return 'nmap'
+        elif 'issues' == name and 'burpVersion' in attributes:
+            return 'burp'
+        elif 'document' == name:
+            if 'SSLyze' in attributes:
+                return 'sslyze'
+            elif 'SSLScan' in attributes:
+                return 'sslscan'
+
+        return None
+
+    def _classify_json(self, text):
+        keys = set(self.JSON_KEY_RE.findall(text))
+        if self.TESTSSL_FLAT_KEYS <= keys or keys & self.TESTSSL_PRETTY_KEYS:
+            return 'testssl'
+
+        return None
@@ -0,0 +1,69 @@
+import gzip
+import io
+import os
+
+# optional, smaller and faster than gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAPPING_SUFFIX = '.mapping.json'
+BULK_SUFFIXES = {
+    'zstd': '.ndjson.zst',
+    'gzip': '.ndjson.gz',
+}
+
+
+def default_compression():
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def open_bulk_file(file_path, mode='rb'):
+    """Open a compressed bulk file (one action and one doc line per entry) for binary reading or writing"""
+    if file_path.endswith(BULK_SUFFIXES['zstd']):
+        if zstandard is None:
+            raise ImportError('The zstandard module is required for file: {}'.format(file_path))
+        raw_file = open(file_path, mode)
+        if 'r' in mode:
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw_file))
+        return zstandard.ZstdCompressor().stream_writer(raw_file)
+
+    return gzip.open(file_path, mode)
+
+
+def find_exports(export_dir):
+    """Return the exported indices of a directory: index name -> (mapping file, bulk file or None)"""
+    exports = {}
+    for file_name in sorted(os.listdir(export_dir)):
+        if file_name.endswith(MAPPING_SUFFIX):
+            index = file_name[:-len(MAPPING_SUFFIX)]
+            exports.setdefault(index, [None, None])[0] = os.path.join(export_dir, file_name)
+        for suffix in BULK_SUFFIXES.values():
+            if file_name.endswith(suffix):
+                index = file_name[:-len(suffix)]
+                exports.setdefault(index, [None, None])[1] = os.path.join(export_dir, file_name)
+
+    return {index: tuple(files) for index, files in exports.items()}
+
+
+def iter_bulk_chunks(file_path, max_docs, max_bytes):
+    """Read a bulk file and yield chunks of (action, doc) lines, limited by number of docs and size in bytes"""
+    chunk = []
+    chunk_bytes = 0
+    with open_bulk_file(file_path, 'rb') as bulk_file:
+        for action in bulk_file:
+            action = action.rstrip(b'\n')
+            if not action:
+                continue
+            doc = bulk_file.readline().rstrip(b'\n')
+            size = len(action) + len(doc) + 2
+            if chunk and (len(chunk) >= max_docs or chunk_bytes + size > max_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append((action, doc))
+            chunk_bytes += size
+
+    if chunk:
+        yield chunk
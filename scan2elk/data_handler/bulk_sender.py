@@ -0,0 +1,50 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class BulkSender:
+    """Send bulk requests in background threads, so parsing and indexing overlap
+
+    At most max_in_flight requests are sent at the same time and max_queued more are waiting. submit() blocks if
+    all slots are taken, which keeps memory bounded. Errors of background requests are raised by the next call of
+    submit() or flush().
+    """
+
+    def __init__(self, send_func, max_in_flight=2, max_queued=2):
+        self._send_func = send_func
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='scan2elk-bulk')
+        self._slots = threading.BoundedSemaphore(max_in_flight + max_queued)
+        self._futures = []
+
+    def submit(self, *args):
+        self.raise_errors()
+        # backpressure: wait for a free slot
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._send_func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def raise_errors(self):
+        # forget finished requests, raise the first error
+        pending = []
+        error = None
+        for future in self._futures:
+            if not future.done():
+                pending.append(future)
+            elif error is None and future.exception() is not None:
+                error = future.exception()
+        self._futures = pending
+        if error is not None:
+            raise error
+
+    def flush(self):
+        # wait for all pending requests
+        wait(self._futures)
+        self.raise_errors()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
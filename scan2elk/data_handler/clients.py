@@ -0,0 +1,22 @@
+import json
+import threading
+
+from elasticsearch import Elasticsearch
+
+from scan2elk.data_handler.serializer import FastJSONSerializer
+
+_CLIENTS = {}
+_LOCK = threading.Lock()
+
+
+def get_client(**options):
+    """Return the process-wide client (and connection pool) for the given connection options"""
+    key = json.dumps(options, sort_keys=True, default=repr)
+    with _LOCK:
+        try:
+            return _CLIENTS[key]
+        except KeyError:
+            client = Elasticsearch(serializer=FastJSONSerializer(), **options)
+            _CLIENTS[key] = client
+
+    return client
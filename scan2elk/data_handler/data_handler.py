@@ -1,26 +1,164 @@
+import gzip
+import hashlib
+import json
 import logging
 import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from functools import partial
 
-from elasticsearch import Elasticsearch, helpers
-import oyaml as yaml
+from elasticsearch.exceptions import ConnectionError, TransportError
+
+from scan2elk.data_handler.bulk_export import BULK_SUFFIXES, MAPPING_SUFFIX, iter_bulk_chunks, open_bulk_file
+from scan2elk.data_handler.bulk_sender import BulkSender
+from scan2elk.data_handler.clients import get_client
+from scan2elk.data_handler.mapping_cache import get_mapping_cache, load_yaml
+from scan2elk.metrics import METRICS
 
 
 LOGGER = logging.getLogger(__name__)
 
+# physical index of a -versioned run: "{alias}-v{YYYYmmddHHMMSS}"
+VERSIONED_INDEX_RE = re.compile(r'^(.+)-v\d{14}$')
+
+
+# metadata doc per project
+PROJECTS_INDEX = 'scan2elk-projects'
+# first part of the index names
+INDEX_TYPES = ('finding', 'host', 'certificate', 'cipher', 'service')
+
+
+def alias_of(index):
+    # name under which an index is searched, versioned indices are only reachable through their alias
+    match = VERSIONED_INDEX_RE.match(index)
+    return match.group(1) if match else index
+
+
+def project_alias(project):
+    # every index of a project has this alias
+    return 'scan2elk-project-{}'.format(project)
+
+
+def project_index_re(project=None):
+    # names (aliases) of the indices of one or all projects: "{index type}_{tool}_{project}"
+    if project is None:
+        return re.compile(r'^(?:{})_[a-z0-9]+_[\w-]+$'.format('|'.join(INDEX_TYPES)))
+    # tool names do not contain "_", so other projects ending with "_{project}" do not match
+    return re.compile(r'^(?:{})_[a-z0-9]+_{}$'.format('|'.join(INDEX_TYPES), re.escape(project)))
+
+
+def swap_aliases(handlers):
+    """Point the aliases of all handlers to the indices of this run in a single atomic request
+
+    Old generations are only deleted once every alias points to the new indices. If the request fails, all aliases
+    keep pointing to the previous data.
+    """
+    actions = [action for handler in handlers for action in handler.alias_actions()]
+    if not actions:
+        return
+    LOGGER.info('Switching aliases: {}'.format(', '.join(sorted(
+        action['add']['alias'] for action in actions if 'add' in action))))
+    handlers[0].update_aliases(actions)
+    for handler in handlers:
+        try:
+            handler.delete_old_generations()
+        except TransportError as e:
+            # the next -versioned run deletes them
+            LOGGER.warning('Unable to delete old generations of {} indices: {}'.format(handler.NAME, e))
+
+
+def merge_host_doc(existing, new):
+    """Merge two serialized docs of the same host, like the parser does for hosts found in several files"""
+    merged = dict(existing)
+    for key, value in new.items():
+        old_value = merged.get(key)
+        if isinstance(old_value, list) and isinstance(value, list):
+            merged[key] = old_value + [v for v in value if v not in old_value]
+        elif isinstance(old_value, dict) and isinstance(value, dict):
+            merged[key] = merge_host_doc(old_value, value)
+        elif (value is not None and value != '') or key not in merged:
+            merged[key] = value
+
+    return merged
+
 
 class DataHandler(object):
 
     NAME = 'to be overwritten in child'
+    # bulk items and requests with these status codes are retried
+    RETRY_STATUS_CODES = {408, 429, 502, 503, 504}
+    # provenance of a doc, not part of its content for -dedupe: the doc of the first file is kept
+    DEDUPE_IGNORED_FIELDS = ('src_file',)
+    # db.yaml options passed to the elasticsearch client
+    TRANSPORT_OPTIONS = ('http_compress', 'maxsize', 'timeout', 'max_retries', 'retry_on_timeout', 'sniff_on_start',
+                         'sniff_on_connection_fail', 'sniffer_timeout', 'sniff_timeout')
+    # call observe_doc() for every doc, i.e. to validate the results in sanity_check()
+    OBSERVE_DOCS = False
 
     def __init__(self, ignoremappings=False):
         super().__init__()
         self.root_path = os.path.realpath(os.path.join(os.path.dirname(__file__), os.path.pardir))
         self.bulk_size = 1200
+        # limits for a single bulk request, see db.yaml
+        self.bulk_max_docs = 600
+        self.bulk_max_bytes = 10 * 1024 * 1024
+        # number of bulk requests sent in background threads, 0 sends synchronously
+        self.bulk_in_flight = 2
+        self.bulk_queue_size = 2
+        self._sender = None
+        # retries of rejected docs, backoff in seconds
+        self.bulk_max_retries = 5
+        self.bulk_initial_backoff = 1.0
+        self.bulk_max_backoff = 60.0
+        # permanently failing docs are appended to this ndjson file
+        self.dead_letter_path = None
+        # index -> counts of indexed, retried and failed docs
+        self.bulk_stats = {}
+        # host id -> fingerprint of the last host doc sent, hosts are only sent again if they changed
+        self._sent_hosts = {}
+        # hosts sent again in this run are merged with their stored doc (DocBuffer writes hosts per batch)
+        self.merge_sent_hosts = False
+        # host id -> fingerprint of the last unmerged host doc, and docs stored before this run (incremental ingest)
+        self._seen_hosts = {}
+        self._stored_hosts = {}
+        self.skipped_hosts = 0
+        # SeenHashSet or BloomFilter of docs sent in this run (-dedupe), identical docs are not sent again
+        self.seen_docs = None
+        self.suppressed_docs = 0
+        # count raw and gzip compressed bytes of bulk requests
+        self.measure_transport = False
+        self.http_compress = False
+        self._stats_lock = threading.Lock()
         self.index_names = {}
-        self.index_types = ['finding', 'host', 'certificate', 'cipher', 'service']
+        self.index_types = list(INDEX_TYPES)
         self.log_data_inserts = False
+        # use "update" with "doc_as_upsert" instead of "index" (incremental ingest)
+        self.upsert = False
+        # no refresh after every flush, see begin_ingest()
+        self.fast_ingest = False
+        self._saved_index_settings = {}
+        # register index templates instead of creating indices, elasticsearch creates them on the first write
+        self.lazy_indices = False
+        # index name -> mapping of registered templates
+        self._index_templates = {}
+        # write mappings and compressed bulk files to this directory instead of sending them (-export-ndjson)
+        self.export_dir = None
+        self.export_compression = 'gzip'
+        self._export_files = {}
+        # write into "{index}-{run_id}" and point the alias "{index}" to it in swap_aliases() (-versioned)
+        self.run_id = None
+        # physical index -> alias
+        self._aliases = {}
+        # project of the indices, see project_alias()
+        self.project = None
 
         self._es = None
+        self._serializer = None
+        # config files used for the mappings, key of the mapping cache
+        self._mapping_files = []
         self.certificate_mapping = {}
         self.cipher_mapping = {}
         self.finding_mapping = {}
@@ -52,11 +190,11 @@ class DataHandler(object):
 
     def get_yaml_file(self, file_path, ignore_error=False):
         yaml_data = {}
+        self._mapping_files.append(file_path)
         try:
-            with open(file_path, 'r') as yaml_file:
-                yaml_data = yaml.safe_load(yaml_file)
-                if not isinstance(yaml_data, dict):
-                    yaml_data = {}
+            yaml_data = load_yaml(file_path)
+            if not isinstance(yaml_data, dict):
+                yaml_data = {}
         except FileNotFoundError:
             if not ignore_error:
                 LOGGER.exception('Error opening config file: {}'.format(file_path))
@@ -87,9 +225,56 @@ class DataHandler(object):
             **self.get_yaml_file(os.path.join(self.root_path, 'config', 'db.yaml')),
             **self.get_yaml_file(os.path.join(self.xdg_config_home, 'db.yaml'), True)
         }
-        self._es = Elasticsearch(host=config['host'], port=config['port'])
+        # all handlers share one client and connection pool
+        transport_options = {k: config[k] for k in self.TRANSPORT_OPTIONS if config.get(k) is not None}
+        self._es = get_client(host=config['host'], port=config['port'], **transport_options)
+        self.http_compress = bool(config.get('http_compress', False))
+        self._serializer = self._es.transport.serializer
+        self.bulk_max_docs = int(config.get('bulk_max_docs', self.bulk_max_docs))
+        self.bulk_max_bytes = int(config.get('bulk_max_bytes', self.bulk_max_bytes))
+        self.bulk_in_flight = int(config.get('bulk_in_flight', self.bulk_in_flight))
+        self.bulk_queue_size = int(config.get('bulk_queue_size', self.bulk_queue_size))
+        self.bulk_max_retries = int(config.get('bulk_max_retries', self.bulk_max_retries))
+        self.bulk_initial_backoff = float(config.get('bulk_initial_backoff', self.bulk_initial_backoff))
+        self.bulk_max_backoff = float(config.get('bulk_max_backoff', self.bulk_max_backoff))
+        self.dead_letter_path = config.get('dead_letter_file', self.dead_letter_path)
+        self.set_bulk_in_flight(self.bulk_in_flight, self.bulk_queue_size)
+
+    def set_bulk_in_flight(self, bulk_in_flight, bulk_queue_size=None):
+        # number of bulk requests sent in background threads, 0 sends synchronously
+        self.close()
+        self.bulk_in_flight = bulk_in_flight
+        if bulk_queue_size is not None:
+            self.bulk_queue_size = bulk_queue_size
+        if self.bulk_in_flight > 0:
+            self._sender = BulkSender(self._bulk_insert, self.bulk_in_flight, self.bulk_queue_size)
 
     def init_mappings(self):
+        mapping_cache = get_mapping_cache()
+        compiled = mapping_cache.get(self.NAME)
+        if compiled is None:
+            self._mapping_files = []
+            self._compile_mappings()
+            compiled = {
+                'settings': self.mapping_settings,
+                'certificate': self.certificate_mapping,
+                'cipher': self.cipher_mapping,
+                'finding': self.finding_mapping,
+                'host': self.host_mapping,
+                'service': self.service_mapping,
+                'dynamic_templates': self.dynamic_templates_mappings,
+            }
+            mapping_cache.put(self.NAME, self._mapping_files, compiled)
+        else:
+            self.mapping_settings = compiled['settings']
+            self.certificate_mapping = compiled['certificate']
+            self.cipher_mapping = compiled['cipher']
+            self.finding_mapping = compiled['finding']
+            self.host_mapping = compiled['host']
+            self.service_mapping = compiled['service']
+            self.dynamic_templates_mappings = compiled['dynamic_templates']
+
+    def _compile_mappings(self):
         # init settings and base mapping once
         self.mapping_settings = {
             **self.get_yaml_file(os.path.join(self.root_path, 'config', 'mappings', 'settings.yaml')),
@@ -112,18 +297,8 @@ class DataHandler(object):
                 break
 
             file_path = os.path.join(self.root_path, 'config', 'mappings', '{}.yaml'.format(index))
-            try:
-                with open(file_path, 'r') as conf_file:
-                    conf = yaml.safe_load(conf_file)
-                    # empty config file
-                    if conf is None:
-                        LOGGER.debug('Empty config file: {}'.format(file_path))
-                        conf = {}
-                    # i.e. self.base_mapping_finding
-                    setattr(self, 'base_mapping_{}'.format(index), conf)
-            except IOError:
-                LOGGER.exception('Error opening config file: {}'.format(file_path))
-                raise
+            # i.e. self.base_mapping_finding
+            setattr(self, 'base_mapping_{}'.format(index), self.get_yaml_file(file_path))
 
         self.certificate_mapping = {**self.base_mapping, **self.base_mapping_certificate,
                                     **self._load_mapping_config('certificate')}
@@ -141,8 +316,20 @@ class DataHandler(object):
                 self.dynamic_templates_mappings.append({k: v})
 
     def create_index(self, name, index, mapping):
+        if self.run_id is not None and self.export_dir is None:
+            # the current index stays searchable until swap_aliases()
+            self._aliases['{}-{}'.format(index, self.run_id)] = index
+            index = '{}-{}'.format(index, self.run_id)
         self.index_names[name] = index
-        self._es.indices.delete(index=index, ignore=[404])
+        if self.export_dir is not None:
+            self._export_mapping(index, mapping)
+            return
+        if self.run_id is None:
+            self._es.indices.delete(index=index, ignore=[404])
+
+        if self.lazy_indices:
+            self._put_index_template(index, mapping)
+            return
 
         self._es.indices.create(
             index=index,
@@ -154,25 +341,250 @@ class DataHandler(object):
                         'properties': mapping,
                     },
                 },
-
+                'aliases': self._project_aliases(),
             },
             include_type_name=True
         )
 
-    def delete_indices(self, project=None):
-        indices = []
-        for existing_index in self._es.indices.get('*').keys():
-            # avoid deleting unrelated indices (not 100% safe though!)
-            if project is None:
-                do_delete = any(existing_index.startswith(x) for x in self.index_types)
+    def _project_aliases(self):
+        # indices of -versioned runs join the project in swap_aliases()
+        if self.project is None or (self.run_id is not None and self.export_dir is None):
+            return {}
+        return {project_alias(self.project): {}}
+
+    def _put_index_template(self, index, mapping, extra_settings=None):
+        self._index_templates[index] = mapping
+        self._es.indices.put_index_template(
+            name=index,
+            body={
+                'index_patterns': [index],
+                'template': {
+                    'settings': {**self.mapping_settings, **(extra_settings or {})},
+                    'mappings': {
+                        'dynamic_templates': self.dynamic_templates_mappings,
+                        'properties': mapping,
+                    },
+                    'aliases': self._project_aliases(),
+                },
+            }
+        )
+
+    def alias_actions(self):
+        """Actions pointing the aliases to the indices of this run, see swap_aliases()"""
+        if not self._aliases:
+            return []
+        aliases = sorted(self._aliases.values())
+        if self.lazy_indices:
+            # aliases need existing indices, create the ones which did not get any docs from their templates
+            for index in self._aliases:
+                self._es.indices.create(index=index, ignore=[400])
+        # current targets of the aliases and concrete indices of runs without -versioned
+        current = self._es.indices.get_alias(name=','.join(aliases), ignore=[404])
+        concrete = self._es.indices.get_settings(index=','.join(aliases), name='index.uuid', ignore_unavailable=True,
+                                                 allow_no_indices=True)
+        actions = []
+        for index, alias in sorted(self._aliases.items()):
+            if alias in concrete:
+                # deleted in the same request
+                actions.append({'remove_index': {'index': alias}})
+            for old_index, data in current.items():
+                # partial 404 responses also contain "error" and "status"
+                if isinstance(data, dict) and alias in data.get('aliases', {}) and old_index != index:
+                    actions.append({'remove': {'index': old_index, 'alias': alias}})
+            actions.append({'add': {'index': index, 'alias': alias}})
+            if self.project is not None:
+                actions.append({'add': {'index': index, 'alias': project_alias(self.project)}})
+
+        return actions
+
+    def update_aliases(self, actions):
+        # all actions are applied atomically
+        self._es.indices.update_aliases(body={'actions': actions})
+
+    def delete_old_generations(self):
+        """Delete all other generations of the indices of this run, including the ones of failed runs"""
+        if not self._aliases:
+            return
+        aliases = sorted(self._aliases.values())
+        generations = self._es.indices.get_settings(index=','.join('{}-v*'.format(alias) for alias in aliases),
+                                                    name='index.uuid', ignore_unavailable=True,
+                                                    allow_no_indices=True)
+        old_indices = sorted(index for index in generations
+                             if index not in self._aliases and alias_of(index) in self._aliases.values())
+        # keep the urls short
+        for i in range(0, len(old_indices), 50):
+            LOGGER.info('Deleting old indices: {}'.format(', '.join(old_indices[i:i + 50])))
+            self._es.indices.delete(index=','.join(old_indices[i:i + 50]), ignore=[404])
+        for old_index in old_indices:
+            self._es.indices.delete_index_template(name=old_index, ignore=[404])
+        self._aliases = {}
+
+    def _export_mapping(self, index, mapping):
+        # typeless, like the index templates
+        body = {
+            'settings': self.mapping_settings,
+            'mappings': {
+                'dynamic_templates': self.dynamic_templates_mappings,
+                'properties': mapping,
+            },
+            'aliases': self._project_aliases(),
+        }
+        with open(os.path.join(self.export_dir, '{}{}'.format(index, MAPPING_SUFFIX)), 'w') as mapping_file:
+            json.dump(body, mapping_file, indent=2, sort_keys=True)
+
+    def import_index(self, index, body):
+        # (re)create an index from an exported mapping
+        self.index_names[index] = index
+        self._es.indices.delete(index=index, ignore=[404])
+        self._es.indices.create(index=index, body=body)
+
+    def load_bulk_file(self, index, file_path):
+        LOGGER.info('Loading {} into index: {}'.format(file_path, index))
+        for chunk in iter_bulk_chunks(file_path, self.bulk_max_docs, self.bulk_max_bytes):
+            if self._sender is not None:
+                self._sender.submit(index, chunk)
             else:
-                do_delete = existing_index.endswith(project)
+                self._bulk_insert(index, chunk)
+
+    def _configured_setting(self, name):
+        # i.e. "refresh_interval" from settings.yaml: flat, nested in "index" or without "index" prefix
+        settings = self.mapping_settings
+        for value in (settings.get('index.{}'.format(name)), settings.get('index', {}).get(name), settings.get(name)):
+            if value is not None:
+                return value
+        return None
+
+    def ensure_index(self, name, index, mapping):
+        # keep existing indices, returns True if the index had to be created
+        if self._es.indices.exists(index=index):
+            self.index_names[name] = index
+            if self.project is not None:
+                # indices of older versions are not registered yet
+                self._es.indices.put_alias(index=index, name=project_alias(self.project))
+            return False
+        # with -lazy-indices, index types without any docs (i.e. ciphers of nmap) only have a template
+        created = not (self.lazy_indices and self._es.indices.exists_index_template(name=index))
+        self.create_index(name, index, mapping)
+        return created
+
+    def delete_file_docs(self, src_file):
+        # remove all docs originating from the given file. hosts are kept, since they are merged across files.
+        # findings and services of several files share their id and only keep the src_file of the last one, such docs
+        # are deleted although unchanged files contain them as well (they are restored by a full reingest)
+        indices = [index for name, index in self.index_names.items() if 'host' != name]
+        if indices:
+            self._es.delete_by_query(index=','.join(indices), body={'query': {'term': {'src_file.raw': src_file}}},
+                                     conflicts='proceed', refresh=True, ignore_unavailable=True)
+
+    def begin_ingest(self):
+        # disable refresh and replicas while loading data, the configured settings are restored in end_ingest()
+        indices = [index for index in self.index_names.values() if index not in self._saved_index_settings]
+        if not indices:
+            return
+        setting_names = ('index.refresh_interval', 'index.number_of_replicas')
+        ingest_settings = {'refresh_interval': '-1', 'number_of_replicas': 0}
+        current_settings = self._es.indices.get_settings(index=','.join(indices), flat_settings=True,
+                                                         ignore_unavailable=True)
+        for index in indices:
+            if index in current_settings:
+                index_settings = current_settings[index].get('settings', {})
+                # None resets a setting to its default
+                self._saved_index_settings[index] = {name: index_settings.get(name) for name in setting_names}
+            else:
+                # index will be created from its template
+                self._saved_index_settings[index] = {name: self._configured_setting(name[len('index.'):])
+                                                     for name in setting_names}
+            if index in self._index_templates:
+                self._put_index_template(index, self._index_templates[index], ingest_settings)
+        self._es.indices.put_settings(index=','.join(indices), body={'index': ingest_settings},
+                                      ignore_unavailable=True)
+        self.fast_ingest = True
+
+    def end_ingest(self, force_merge=False):
+        # the settings are also restored if the remaining bulk requests fail, their error is raised afterwards
+        try:
+            self.flush()
+        finally:
+            indices, error = self._restore_index_settings()
+        if error is not None:
+            raise error
+        if indices:
+            with METRICS.timer('refresh'):
+                self._es.indices.refresh(index=','.join(indices), ignore_unavailable=True)
+            if force_merge:
+                LOGGER.info('Force merging indices: {}'.format(', '.join(indices)))
+                self._es.indices.forcemerge(index=','.join(indices), max_num_segments=1, ignore_unavailable=True)
+
+    def _restore_index_settings(self):
+        # index by index, one failing request does not keep the other indices without refresh and replicas
+        restored = []
+        error = None
+        for index in list(self._saved_index_settings.keys()):
+            LOGGER.info('Restoring settings of index: {}'.format(index))
+            try:
+                self._es.indices.put_settings(index=index, body=self._saved_index_settings[index],
+                                              ignore_unavailable=True)
+                if index in self._index_templates:
+                    self._put_index_template(index, self._index_templates[index])
+            except TransportError as e:
+                LOGGER.error('Unable to restore settings of index {}: {}'.format(index, e))
+                error = error or e
+                continue
+            del self._saved_index_settings[index]
+            restored.append(index)
+        self.fast_ingest = False
+
+        return restored, error
+
+    def register_project(self, project, indices):
+        """Store the metadata doc of a project, indices are the names (aliases) written by this run"""
+        existing = self._es.get(index=PROJECTS_INDEX, id=project, ignore=[404])
+        known_indices = set(existing.get('_source', {}).get('indices', []))
+        self._es.index(index=PROJECTS_INDEX, id=project, refresh=True, body={
+            'project': project,
+            'alias': project_alias(project),
+            'indices': sorted(known_indices | set(indices)),
+            'updated': datetime.now(timezone.utc).isoformat(),
+        })
+
+    def find_project_indices(self, project=None):
+        """Physical indices of one or all projects, resolved by a single request for names only"""
+        if project is None:
+            patterns = [project_alias('*')] + ['{}_*'.format(index_type) for index_type in self.index_types]
+        else:
+            # indices of older versions do not have the project alias
+            patterns = [project_alias(project)] + ['{}_*_{}{}'.format(index_type, project, suffix)
+                                                   for index_type in self.index_types for suffix in ('', '-v*')]
+        name_re = project_index_re(project)
+        settings = self._es.indices.get_settings(index=','.join(patterns), name='index.uuid', ignore_unavailable=True,
+                                                 allow_no_indices=True)
+
+        return sorted(index for index in settings if name_re.match(alias_of(index)))
+
+    def find_project_templates(self, project=None):
+        """Index templates of -lazy-indices registered for one or all projects"""
+        # a single name pattern per request, it also matches other projects ending with "_{project}"
+        res = self._es.indices.get_index_template(name='*' if project is None else '*_{}*'.format(project),
+                                                  ignore=[404])
+        name_re = project_index_re(project)
+
+        return sorted(template['name'] for template in res.get('index_templates', [])
+                      if name_re.match(alias_of(template['name'])))
 
-            if do_delete:
-                self._es.indices.delete(index=existing_index)
-                indices.append(existing_index)
+    def delete_indices(self, project=None):
+        indices = self.find_project_indices(project)
+        # keep the urls short
+        for i in range(0, len(indices), 50):
+            self._es.indices.delete(index=','.join(indices[i:i + 50]), ignore=[404])
         if len(indices) > 0:
-            print('Deleted indices: {}'.format(', '.join(sorted(indices))))
+            print('Deleted indices: {}'.format(', '.join(indices)))
+        if project is None:
+            self._es.indices.delete(index=PROJECTS_INDEX, ignore=[404])
+        else:
+            self._es.delete(index=PROJECTS_INDEX, id=project, refresh=True, ignore=[404])
+        # index templates of -lazy-indices, matched like the indices
+        for template in self.find_project_templates(project):
+            self._es.indices.delete_index_template(name=template, ignore=[404])
 
     def process_findings(self, findings):
         LOGGER.info('Processing findings')
@@ -180,7 +592,52 @@ class DataHandler(object):
 
     def process_hosts(self, hosts):
         LOGGER.info('Processing hosts')
-        self._process_data(hosts, self.index_names['host'])
+        index = self.index_names['host']
+        if self.export_dir is None and (self.upsert or self.merge_sent_hosts):
+            hosts = self._merge_stored_hosts(index, hosts)
+        self._process_data(hosts, index, self._is_changed_host)
+
+    def _merge_stored_hosts(self, index, hosts):
+        # partial updates replace arrays (i.e. ports) and full docs replace everything, so hosts which may be stored
+        # already are merged with their stored doc first
+        dumps = self._serializer.dumps_bytes
+        batch = []
+        for host in hosts:
+            # unchanged since the last call (i.e. the hosts of the serial parser), nothing to merge or send
+            fingerprint = hashlib.blake2b(dumps(host), digest_size=8).digest()
+            if self._seen_hosts.get(host['id']) == fingerprint:
+                self.skipped_hosts += 1
+                continue
+            self._seen_hosts[host['id']] = fingerprint
+            batch.append(host)
+            if len(batch) >= self.bulk_max_docs:
+                yield from self._merge_host_batch(index, batch)
+                batch = []
+        if batch:
+            yield from self._merge_host_batch(index, batch)
+
+    def _merge_host_batch(self, index, hosts):
+        if self.merge_sent_hosts:
+            # hosts of earlier batches are only stored in elasticsearch, without incremental ingest only they can be
+            # stored at all
+            ids = [host['id'] for host in hosts if self.upsert or host['id'] in self._sent_hosts]
+            if any(host['id'] in self._sent_hosts for host in hosts):
+                # the bulk requests of this run have to be finished
+                self.flush()
+        else:
+            # the parser holds the merged state of the hosts sent in this run, only the docs stored before this run
+            # are fetched (once)
+            ids = [host['id'] for host in hosts if host['id'] not in self._sent_hosts]
+        stored = {}
+        if ids:
+            res = self._es.mget(index=index, body={'ids': ids}, ignore=[404])
+            stored = {doc['_id']: doc['_source'] for doc in res.get('docs', []) if doc.get('found')}
+        if not self.merge_sent_hosts:
+            # a partial update with the hosts of the parser would replace the arrays of the stored docs again
+            self._stored_hosts.update(stored)
+            stored = self._stored_hosts
+
+        return [merge_host_doc(stored[host['id']], host) if host['id'] in stored else host for host in hosts]
 
     def process_certificates(self, certificates):
         LOGGER.info('Processing certificates')
@@ -194,42 +651,224 @@ class DataHandler(object):
         LOGGER.info('Processing services')
         self._process_data(services, self.index_names['service'])
 
-    def _process_data(self, data, index):
-        bulk_data = []
+    def _is_changed_host(self, entry, doc):
+        # 8 byte digest of the serialized doc
+        fingerprint = hashlib.blake2b(doc, digest_size=8).digest()
+        if self._sent_hosts.get(entry['id']) == fingerprint:
+            self.skipped_hosts += 1
+            return False
+        self._sent_hosts[entry['id']] = fingerprint
+        return True
+
+    def _is_new_doc(self, index, entry, doc):
+        # 64 bit hash of index, id and content, the same finding of overlapping scan files differs in src_file only
+        if any(field in entry for field in self.DEDUPE_IGNORED_FIELDS):
+            doc = self._serializer.dumps_bytes({key: value for key, value in entry.items()
+                                                if key not in self.DEDUPE_IGNORED_FIELDS})
+        digest = hashlib.blake2b('{}\0{}\0'.format(index, entry['id']).encode('utf-8'), digest_size=8)
+        digest.update(doc)
+        if self.seen_docs.add(int.from_bytes(digest.digest(), 'little')):
+            return True
+        self.suppressed_docs += 1
+        METRICS.count(index=index, suppressed=1)
+        return False
+
+    def _process_data(self, data, index, doc_filter=None):
+        if doc_filter is None and self.seen_docs is not None:
+            doc_filter = partial(self._is_new_doc, index)
+        if self.OBSERVE_DOCS:
+            data = self._observe_docs(index, data)
+        if self.export_dir is not None:
+            for chunk in self._chunk_actions(data, doc_filter):
+                self._export_chunk(index, chunk)
+            return
+        # only one chunk is held in memory at a time
+        sent = False
+        for chunk in self._chunk_actions(data, doc_filter):
+            sent = True
+            if self._sender is not None:
+                self._sender.submit(index, chunk)
+            else:
+                self._bulk_insert(index, chunk)
+        # refresh index
+        if sent and not self.fast_ingest:
+            self.flush()
+            with METRICS.timer('refresh', index=index):
+                self._es.indices.refresh(index=index)
+
+    def _observe_docs(self, index, data):
+        for entry in data:
+            self.observe_doc(index, entry)
+            yield entry
+
+    def observe_doc(self, index, entry):
+        return
+
+    def flush(self):
+        # wait for background bulk requests, raises their errors
+        if self._sender is not None:
+            self._sender.flush()
+
+    def close(self):
+        if self._sender is not None:
+            self._sender.shutdown()
+            self._sender = None
+        for export_file in self._export_files.values():
+            export_file.close()
+        self._export_files = {}
+
+    def _export_chunk(self, index, chunk):
+        # one compressed bulk file per index, the actions do not contain the index name
+        try:
+            export_file = self._export_files[index]
+        except KeyError:
+            file_path = os.path.join(self.export_dir, '{}{}'.format(index, BULK_SUFFIXES[self.export_compression]))
+            LOGGER.info('Exporting index {} to: {}'.format(index, file_path))
+            export_file = self._export_files[index] = open_bulk_file(file_path, 'wb')
+        body = b''.join(b'%s\n%s\n' % (action, doc) for action, doc in chunk)
+        export_file.write(body)
+        METRICS.count(index=index, docs=len(chunk), bytes=len(body))
+        self._update_stats(index, indexed=len(chunk))
+
+    def _chunk_actions(self, data, doc_filter=None):
+        # like elasticsearch.helpers.streaming_bulk: split the serialized actions into chunks,
+        # limited by number of docs and by size in bytes. every doc is encoded exactly once.
+        # doc_filter(entry, encoded_doc) may return False to skip a doc
+        dumps = self._serializer.dumps_bytes
+        chunk = []
+        chunk_bytes = 0
 
         for entry in data:
             # also set "_id" manually in order to prevent duplicates
             # -> the id field is unique and shoult not exist more than once
-            bulk_data.append({
-                'index': {
-                    '_type': '_doc',
-                    '_id': entry['id'],
-                }
-            })
-            bulk_data.append(entry)
+            if self.upsert:
+                action = dumps({
+                    'update': {
+                        '_type': '_doc',
+                        '_id': entry['id'],
+                    }
+                })
+                doc = dumps({'doc': entry, 'doc_as_upsert': True})
+            else:
+                action = dumps({
+                    'index': {
+                        '_type': '_doc',
+                        '_id': entry['id'],
+                    }
+                })
+                doc = dumps(entry)
+            if doc_filter is not None and not doc_filter(entry, doc):
+                continue
             if self.log_data_inserts:
                 LOGGER.debug(sorted(entry.items()))
 
-            # write to db
-            if len(bulk_data) >= self.bulk_size:
-                self._bulk_insert(index, bulk_data)
-                bulk_data = []
-        # insert the rest of the data
-        self._bulk_insert(index, bulk_data)
-        # refresh index
-        self._es.indices.refresh(index=index)
-
-    def _bulk_insert(self, index, bulk_data):
-        if len(bulk_data) > 0:
-            LOGGER.info('Writing {} entries to index: {}'.format(int(len(bulk_data)/2), index))
-            bulk_res = self._es.bulk(index=index, body=bulk_data, refresh=False)
+            # +2 for the newlines
+            size = len(action) + len(doc) + 2
+            if chunk and (len(chunk) >= self.bulk_max_docs or chunk_bytes + size > self.bulk_max_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append((action, doc))
+            chunk_bytes += size
+
+        if chunk:
+            yield chunk
+
+    def _backoff(self, attempt):
+        # exponential backoff with full jitter
+        time.sleep(random.uniform(0, min(self.bulk_max_backoff, self.bulk_initial_backoff * 2 ** attempt)))
+
+    def _bulk_insert(self, index, chunk):
+        attempt = 0
+        while len(chunk) > 0:
+            LOGGER.info('Writing {} entries to index: {}'.format(len(chunk), index))
+            # pre-encoded ndjson, the client sends it as it is
+            body = b''.join(b'%s\n%s\n' % (action, doc) for action, doc in chunk)
+            if self.measure_transport:
+                # the client compresses the same way
+                gzip_bytes = len(gzip.compress(body))
+                self._update_stats(index, raw_bytes=len(body), gzip_bytes=gzip_bytes,
+                                   sent_bytes=gzip_bytes if self.http_compress else len(body))
+            METRICS.count(index=index, bulk_requests=1, bytes=len(body))
             try:
-                if bulk_res['errors']:
-                    LOGGER.error('Error while inserting data')
-                    LOGGER.error(bulk_res['items'][0]['index']['error'])
-                    raise Exception('Error while inserting into db')
-            except KeyError:
-                pass
+                with METRICS.timer('bulk_http', index=index):
+                    bulk_res = self._es.bulk(index=index, body=body, refresh=False)
+            except TransportError as e:
+                # connection errors and timeouts do not have a numeric status code
+                if attempt >= self.bulk_max_retries or \
+                        not (isinstance(e, ConnectionError) or e.status_code in self.RETRY_STATUS_CODES):
+                    raise
+                LOGGER.warning('Bulk request to index {} failed ({}), retrying'.format(index, e))
+                self._update_stats(index, retried=len(chunk))
+                self._backoff(attempt)
+                attempt += 1
+                continue
+
+            retry = []
+            failed = []
+            for (action, doc), item in zip(chunk, bulk_res['items']):
+                # "index" or "update"
+                result = list(item.values())[0]
+                if 'error' not in result:
+                    continue
+                if result['status'] in self.RETRY_STATUS_CODES and attempt < self.bulk_max_retries:
+                    retry.append((action, doc))
+                else:
+                    failed.append((action, doc, result))
+
+            self._update_stats(index, indexed=len(chunk) - len(retry) - len(failed), retried=len(retry),
+                               failed=len(failed))
+            METRICS.count(index=index, docs=len(chunk) - len(retry) - len(failed))
+            if failed:
+                LOGGER.error('Unable to insert {} entries into index {}, first error: {}'.format(
+                    len(failed), index, failed[0][2]['error']))
+                self._write_dead_letters(index, failed)
+            if retry:
+                LOGGER.warning('{} entries were rejected by index {}, retrying'.format(len(retry), index))
+                self._backoff(attempt)
+                attempt += 1
+            chunk = retry
+
+    @property
+    def failed_docs(self):
+        # docs which could not be inserted, also after all retries
+        return sum(stats['failed'] for stats in self.bulk_stats.values())
+
+    def _update_stats(self, index, **counts):
+        with self._stats_lock:
+            stats = self.bulk_stats.setdefault(index, {'indexed': 0, 'retried': 0, 'failed': 0, 'raw_bytes': 0,
+                                                       'gzip_bytes': 0, 'sent_bytes': 0})
+            for name, count in counts.items():
+                stats[name] += count
+
+    def _write_dead_letters(self, index, failed):
+        if not self.dead_letter_path:
+            return
+        dumps = self._serializer.dumps_bytes
+        with self._stats_lock:
+            with open(self.dead_letter_path, 'ab') as dead_letter_file:
+                for action, doc, result in failed:
+                    meta = dumps({'index': index, 'status': result.get('status'), 'error': result.get('error')})
+                    # one json object per line, action and doc are already encoded
+                    dead_letter_file.write(b'%s,"action":%s,"doc":%s}\n' % (meta[:-1], action, doc))
+
+    def log_summary(self):
+        for index, stats in sorted(self.bulk_stats.items()):
+            LOGGER.info('Index {}: {indexed} indexed, {retried} retried, {failed} failed'.format(index, **stats))
+            if self.measure_transport and stats['raw_bytes']:
+                LOGGER.info('Index {}: {sent_bytes} bytes sent, {raw_bytes} raw bytes, {gzip_bytes} gzip bytes '
+                            '({ratio:.1%} of raw)'.format(index, ratio=stats['gzip_bytes'] / stats['raw_bytes'],
+                                                          **stats))
+        if self.skipped_hosts:
+            LOGGER.info('{}: {} unchanged hosts were not sent again'.format(self.NAME, self.skipped_hosts))
+        if self.suppressed_docs:
+            LOGGER.info('{}: {} duplicate docs were suppressed'.format(self.NAME, self.suppressed_docs))
+        if self.failed_docs:
+            if self.dead_letter_path:
+                LOGGER.warning('Failed entries were written to: {}'.format(self.dead_letter_path))
+            else:
+                LOGGER.error('{}: {} entries could not be inserted and were dropped, use -dead-letter to keep '
+                             'them'.format(self.NAME, self.failed_docs))
 
     def sanity_check(self):
         return
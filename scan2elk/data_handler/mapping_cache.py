@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+
+import oyaml as yaml
+
+LOGGER = logging.getLogger(__name__)
+
+_YAML_FILES = {}
+_MAPPING_CACHE = None
+
+
+def file_mtime(file_path):
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_yaml(file_path):
+    # every (unmodified) yaml file is parsed only once per process
+    key = (file_path, os.stat(file_path).st_mtime_ns)
+    try:
+        return _YAML_FILES[key]
+    except KeyError:
+        pass
+
+    with open(file_path, 'r') as yaml_file:
+        yaml_data = yaml.safe_load(yaml_file)
+    _YAML_FILES[key] = yaml_data
+
+    return yaml_data
+
+
+class MappingCache:
+    """Merged mappings per handler, stored as json and invalidated if any of the used config files changes"""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.cache_path, 'r') as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self._entries = {}
+
+        return self._entries
+
+    def get(self, name):
+        entry = self._load().get(name)
+        if entry is None:
+            return None
+        # config file paths and mtimes (None for missing files) are the cache key
+        if any(file_mtime(file_path) != mtime for file_path, mtime in entry['files']):
+            LOGGER.debug('Config files changed, recompiling mappings of: {}'.format(name))
+            return None
+
+        return entry['mappings']
+
+    def put(self, name, file_paths, mappings):
+        self._load()[name] = {
+            'files': [[file_path, file_mtime(file_path)] for file_path in file_paths],
+            'mappings': mappings,
+        }
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self._entries, cache_file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            LOGGER.debug('Cannot write mapping cache: {}'.format(self.cache_path))
+
+
+def get_mapping_cache():
+    global _MAPPING_CACHE
+    if _MAPPING_CACHE is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        _MAPPING_CACHE = MappingCache(os.path.join(cache_home, 'scan2elk', 'mappings.json'))
+
+    return _MAPPING_CACHE
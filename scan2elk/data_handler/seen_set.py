@@ -0,0 +1,80 @@
+import math
+from array import array
+
+
+class SeenHashSet:
+    """Exact set of 64 bit hashes, 8 bytes per slot in an open addressing table (linear probing)
+
+    Uses about 16 bytes per hash instead of ~70 for a python set of ints.
+    """
+
+    def __init__(self, capacity=1024):
+        size = 1
+        while size < capacity * 2:
+            size *= 2
+        self._table = array('Q', bytes(8 * size))
+        self._mask = size - 1
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def add(self, value):
+        """Add a 64 bit hash, returns False if it was already in the set"""
+        # 0 marks empty slots
+        value = value or 1
+        table = self._table
+        slot = value & self._mask
+        while table[slot]:
+            if table[slot] == value:
+                return False
+            slot = (slot + 1) & self._mask
+        table[slot] = value
+        self._len += 1
+        # keep the load factor below 0.5
+        if self._len * 2 > len(table):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old_table = self._table
+        self._table = array('Q', bytes(8 * len(old_table) * 2))
+        self._mask = len(self._table) - 1
+        for value in old_table:
+            if value:
+                slot = value & self._mask
+                while self._table[slot]:
+                    slot = (slot + 1) & self._mask
+                self._table[slot] = value
+
+
+class BloomFilter:
+    """Bloom filter for 64 bit hashes with a fixed capacity and false positive rate
+
+    A false positive means that a new value is reported as already seen.
+    """
+
+    def __init__(self, capacity=1000000, fp_rate=0.001):
+        capacity = max(1, capacity)
+        self.num_bits = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def add(self, value):
+        """Add a 64 bit hash, returns False if it was (probably) already added"""
+        # double hashing with both halves of the value
+        hash1 = value & 0xffffffff
+        hash2 = (value >> 32) | 1
+        new = False
+        for i in range(self.num_hashes):
+            bit = (hash1 + i * hash2) % self.num_bits
+            if not self._bits[bit >> 3] & (1 << (bit & 7)):
+                self._bits[bit >> 3] |= 1 << (bit & 7)
+                new = True
+        if new:
+            self._len += 1
+        return new
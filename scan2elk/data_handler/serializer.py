@@ -0,0 +1,44 @@
+import ipaddress
+
+from elasticsearch.serializer import JSONSerializer
+
+# optional, much faster json encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONSerializer(JSONSerializer):
+    """JSON serializer for the elasticsearch client which uses orjson if it is installed
+
+    Dates, sets and IP address objects are encoded the same way with and without orjson.
+    """
+
+    def default(self, data):
+        if isinstance(data, (set, frozenset)):
+            return list(data)
+        if isinstance(data, (ipaddress.IPv4Address, ipaddress.IPv6Address, ipaddress.IPv4Network,
+                             ipaddress.IPv6Network, ipaddress.IPv4Interface, ipaddress.IPv6Interface)):
+            return str(data)
+
+        # date, datetime, Decimal, UUID, ...
+        return super().default(data)
+
+    def dumps(self, data):
+        # already encoded (i.e. bulk bodies)
+        if isinstance(data, (str, bytes)):
+            return data
+
+        return self.dumps_bytes(data).decode('utf-8')
+
+    def dumps_bytes(self, data):
+        """Encode data to utf-8 json, i.e. a single line of a bulk body"""
+        if orjson is not None:
+            try:
+                return orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                # i.e. integers exceeding 64 bits, let the standard library try (and fail)
+                pass
+
+        return super().dumps(data).encode('utf-8')
@@ -1,8 +1,5 @@
 import logging
 
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import Q
-
 from scan2elk.data_handler.data_handler import DataHandler
 
 LOGGER = logging.getLogger(__name__)
@@ -11,21 +8,34 @@ LOGGER = logging.getLogger(__name__)
 class TestsslHandler(DataHandler):
 
     NAME = 'testssl'
+    OBSERVE_DOCS = True
 
     def __init__(self):
         super().__init__()
+        # (src_file, ip) -> ports with a "TLS1_2" finding / ports of services
+        self.tls_ports = {}
+        self.service_ports = {}
+
+    def observe_doc(self, index, entry):
+        if index == self.index_names.get('finding'):
+            if 'TLS1_2' != entry.get('name'):
+                return
+            ports = self.tls_ports
+        elif index == self.index_names.get('service'):
+            ports = self.service_ports
+        else:
+            return
+        ports.setdefault((entry.get('src_file'), entry.get('ip')), set()).add(entry.get('port'))
 
     def sanity_check(self):
-        index_findings = self.index_names['finding']
-        index_servicess = self.index_names['service']
-        search_tls = Search(using=self._es, index=index_findings)
-        search_service = Search(using=self._es, index=index_servicess)
-        # get number of findings for finding "TLS1_2"
-        num_tls = search_tls.query(Q({'query_string': {'query': 'name.raw:"TLS1_2"'}})).count()
-        # get number of services
-        num_host = search_service.query(Q({'query_string': {'query': '*'}})).count()
-        # number of findings for "TLS1_2" must match number of detected services
-        # TODO: does not work if multiple hosts in one file
-        if num_tls != num_host:
-            LOGGER.warning('Wrong testssl format detected. Found {} hosts and {} entries for finding "TLS1_2".'
-                           ' Check the manual on how to use testssl'.format(num_host, num_tls))
+        # testssl writes a "TLS1_2" finding for every service, checked per file and host
+        hosts = self.tls_ports.keys() | self.service_ports.keys()
+        invalid = sorted((src_file or '', ip or '') for src_file, ip in hosts
+                         if self.tls_ports.get((src_file, ip)) != self.service_ports.get((src_file, ip)))
+        if invalid:
+            LOGGER.warning('Wrong testssl format detected for {} of {} hosts. Found different ports for services and '
+                           'entries for finding "TLS1_2", i.e. host {} in file {}. Check the manual on how to use '
+                           'testssl'.format(len(invalid), len(hosts), invalid[0][1], invalid[0][0]))
+            for src_file, ip in invalid:
+                LOGGER.debug('testssl: services and "TLS1_2" findings differ for host {} in file {}'.format(
+                    ip, src_file))
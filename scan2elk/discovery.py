@@ -0,0 +1,149 @@
+import logging
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+
+def compile_glob(pattern):
+    """Translate a gitignore-style glob into (regex, directories_only)
+
+    Patterns without a slash match the name at any depth, other patterns are relative to the start directory.
+    "**" matches any number of directories, a trailing slash only matches directories.
+    """
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif '*' == pattern[i]:
+            regex.append('[^/]*')
+            i += 1
+        elif '?' == pattern[i]:
+            regex.append('[^/]')
+            i += 1
+        elif '[' == pattern[i] and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[{}]'.format(chars.replace('\\', '\\\\')))
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    if not anchored:
+        regex.insert(0, '(?:.*/)?')
+
+    return re.compile(''.join(regex)), dir_only
+
+
+class FileDiscovery:
+    """Find files below directories with os.scandir, subdirectories are scanned concurrently by a thread pool
+
+    Files are yielded while the walk is still running. Excluded directories are not descended into, if a directory
+    matches an include glob, all files below it are included.
+    """
+
+    def __init__(self, include=(), exclude=(), max_depth=None, threads=8, file_filter=None):
+        self.include = [compile_glob(pattern) for pattern in include]
+        self.exclude = [compile_glob(pattern) for pattern in exclude]
+        # directory levels below the start directories, 0 only yields the files in them
+        self.max_depth = max_depth
+        self.threads = max(1, threads)
+        # file_filter(name) -> bool, i.e. for file extensions
+        self.file_filter = file_filter
+
+        self._results = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _matches(rules, rel_path, is_dir):
+        return any(regex.fullmatch(rel_path) for regex, dir_only in rules if is_dir or not dir_only)
+
+    def iter_files(self, directories):
+        """Yield the real paths of all matching files below the directories (unordered)"""
+        self._results = queue.Queue()
+        self._stop.clear()
+        # held until all start directories are submitted, scans finishing early do not end the walk
+        self._pending = 1
+        executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='discovery')
+        try:
+            for directory in directories:
+                directory = os.path.realpath(directory)
+                if not os.path.isdir(directory):
+                    LOGGER.error('Unknown directory "{}"'.format(directory))
+                    continue
+                self._submit(executor, directory, '', 0, not self.include)
+            self._release()
+
+            while True:
+                file_path = self._results.get()
+                if file_path is None:
+                    return
+                yield file_path
+        finally:
+            # the consumer may stop early
+            self._stop.set()
+            executor.shutdown(wait=True)
+
+    def _submit(self, executor, path, rel_path, depth, included):
+        with self._lock:
+            self._pending += 1
+        try:
+            executor.submit(self._scan_directory, executor, path, rel_path, depth, included)
+        except RuntimeError:
+            # shut down, the consumer stopped
+            self._release()
+
+    def _release(self):
+        # the last pending directory ends the walk
+        with self._lock:
+            self._pending -= 1
+            if 0 == self._pending:
+                self._results.put(None)
+
+    def _scan_directory(self, executor, path, rel_path, depth, included):
+        try:
+            if self._stop.is_set():
+                return
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    entry_rel_path = '{}/{}'.format(rel_path, entry.name) if rel_path else entry.name
+                    try:
+                        # symlinks to directories are not followed, like os.walk
+                        if entry.is_dir(follow_symlinks=False):
+                            if self._matches(self.exclude, entry_rel_path, True):
+                                continue
+                            if self.max_depth is None or depth < self.max_depth:
+                                self._submit(executor, entry.path, entry_rel_path, depth + 1,
+                                             included or self._matches(self.include, entry_rel_path, True))
+                        elif entry.is_file():
+                            if self.file_filter is not None and not self.file_filter(entry.name):
+                                continue
+                            if self._matches(self.exclude, entry_rel_path, False):
+                                continue
+                            if not (included or self._matches(self.include, entry_rel_path, False)):
+                                continue
+                            # the directory is already resolved, only symlinked files need a realpath
+                            self._results.put(os.path.realpath(entry.path) if entry.is_symlink() else entry.path)
+                    except OSError:
+                        LOGGER.exception('Cannot access: {}'.format(entry.path))
+        except OSError:
+            LOGGER.exception('Cannot read directory: {}'.format(path))
+        finally:
+            self._release()
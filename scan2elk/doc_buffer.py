@@ -0,0 +1,66 @@
+from scan2elk.data_handler.data_handler import merge_host_doc
+from scan2elk.metrics import METRICS
+from scan2elk.parse_worker import RESULT_ATTRIBUTES
+
+RESULT_TYPES = tuple(RESULT_ATTRIBUTES.keys())
+
+
+class DocBuffer:
+    """Collect serialized docs of several files (or hosts) and write them in bulk_size batches
+
+    Hosts are merged within a batch and written with it. Hosts which show up again in a later batch are merged with
+    their stored doc by the handler. Exported hosts cannot be merged later, so they are only written by finish().
+    """
+
+    def __init__(self, elk_handler):
+        self.elk_handler = elk_handler
+        self.elk_handler.merge_sent_hosts = True
+        self.keep_hosts = elk_handler.export_dir is not None
+        self.hosts = {}
+        self.pending = self._empty()
+
+    def _empty(self):
+        return {index_type: [] for index_type in self.elk_handler.index_types if 'host' != index_type}
+
+    def add(self, docs):
+        # timings of the worker, if any
+        src_file = docs.get('src_file')
+        for stage, seconds in docs.get('timings', {}).items():
+            METRICS.add_time(stage, seconds, file=src_file)
+        if src_file is not None:
+            METRICS.count(file=src_file, docs=sum(len(docs[index_type]) for index_type in RESULT_TYPES))
+
+        for host in docs['host']:
+            try:
+                self.hosts[host['id']] = merge_host_doc(self.hosts[host['id']], host)
+            except KeyError:
+                self.hosts[host['id']] = host
+        for index_type in self.pending:
+            self.pending[index_type].extend(docs[index_type])
+
+        if any(len(x) > self.elk_handler.bulk_size for x in self.pending.values()) or \
+                (not self.keep_hosts and len(self.hosts) > self.elk_handler.bulk_size):
+            self.flush()
+
+    def flush(self):
+        docs = self.pending
+        self.pending = self._empty()
+        hosts = []
+        if not self.keep_hosts:
+            hosts = list(self.hosts.values())
+            self.hosts = {}
+        if docs['finding']:
+            self.elk_handler.process_findings(docs['finding'])
+        if docs['certificate']:
+            self.elk_handler.process_certificates(docs['certificate'])
+        if docs['cipher']:
+            self.elk_handler.process_ciphers(docs['cipher'])
+        if hosts:
+            self.elk_handler.process_hosts(hosts)
+        if docs['service']:
+            self.elk_handler.process_services(docs['service'])
+
+    def finish(self):
+        # process remaining
+        self.keep_hosts = False
+        self.flush()
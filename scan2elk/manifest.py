@@ -0,0 +1,85 @@
+import hashlib
+import logging
+import os
+import sqlite3
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FileManifest:
+    """SQLite backed list of ingested files per project, used for incremental ingest"""
+
+    NEW = 'new'
+    CHANGED = 'changed'
+    UNCHANGED = 'unchanged'
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._db = sqlite3.connect(db_path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files (project TEXT, path TEXT, tool TEXT, size INTEGER, '
+                         'mtime REAL, sha256 TEXT, PRIMARY KEY (project, path))')
+        self._db.commit()
+
+    @staticmethod
+    def hash_file(file_path, block_size=1024 * 1024):
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as hash_file:
+            for block in iter(lambda: hash_file.read(block_size), b''):
+                sha256.update(block)
+
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _resolve(local_path):
+        return local_path() if callable(local_path) else local_path
+
+    def check(self, project, file_path, local_path=None, size=None, mtime=None):
+        """Compare a file with its manifest entry. Returns the state and the current fingerprint
+
+        The file is only hashed if size or mtime differ from the stored values. Archive members are stored with their
+        own path, size and mtime and are hashed from a local copy: local_path may be a callable which creates the copy
+        and returns its path, it is only called if the member has to be hashed.
+        """
+        if local_path is None:
+            local_path = file_path
+        if size is None or mtime is None:
+            stat = os.stat(self._resolve(local_path))
+            size, mtime = stat.st_size, stat.st_mtime
+        row = self._db.execute('SELECT size, mtime, sha256 FROM files WHERE project = ? AND path = ?',
+                               (project, file_path)).fetchone()
+        if row is None:
+            return self.NEW, (size, mtime, self.hash_file(self._resolve(local_path)))
+
+        stored_size, stored_mtime, sha256 = row
+        if stored_size == size and stored_mtime == mtime:
+            return self.UNCHANGED, row
+
+        fingerprint = (size, mtime, self.hash_file(self._resolve(local_path)))
+        if sha256 == fingerprint[2]:
+            # only touched, remember the new mtime
+            self._db.execute('UPDATE files SET size = ?, mtime = ? WHERE project = ? AND path = ?',
+                             (size, mtime, project, file_path))
+            self._db.commit()
+            return self.UNCHANGED, fingerprint
+
+        return self.CHANGED, fingerprint
+
+    def add(self, project, tool, file_path, fingerprint):
+        size, mtime, sha256 = fingerprint
+        self._db.execute('INSERT OR REPLACE INTO files (project, path, tool, size, mtime, sha256) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (project, file_path, tool, size, mtime, sha256))
+
+    def commit(self):
+        self._db.commit()
+
+    def delete_project(self, project=None):
+        if project is None:
+            self._db.execute('DELETE FROM files')
+        else:
+            self._db.execute('DELETE FROM files WHERE project = ?', (project,))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
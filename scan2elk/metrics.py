@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Timings and counters of an ingest run: per stage, per file and per index
+
+    Stages are i.e. "download" (Nessus exports), "discovery", "archive" (reading archives), "classify", "spool" (copies
+    of archive members), "parse", "serialize", "bulk_http", "refresh" and "sanity_check".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self.stages = {}
+        self.files = {}
+        self.indices = {}
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.time()
+            self.stages = {}
+            self.files = {}
+            self.indices = {}
+
+    def add_time(self, stage, seconds, file=None, index=None):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if file is not None:
+                file_stats = self.files.setdefault(str(file), {})
+                file_stats['{}_seconds'.format(stage)] = file_stats.get('{}_seconds'.format(stage), 0.0) + seconds
+            if index is not None:
+                index_stats = self.indices.setdefault(index, {})
+                index_stats['{}_seconds'.format(stage)] = index_stats.get('{}_seconds'.format(stage), 0.0) + seconds
+
+    def count(self, file=None, index=None, **counters):
+        with self._lock:
+            if file is not None:
+                stats = self.files.setdefault(str(file), {})
+            else:
+                stats = self.indices.setdefault(index, {})
+            for name, value in counters.items():
+                stats[name] = stats.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, stage, file=None, index=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, file, index)
+
+    def timed_iter(self, stage, iterable, file=None, index=None):
+        # time spent producing the entries of a (lazy) iterable, i.e. to_serializable_dict() calls
+        seconds = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    entry = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield entry
+        finally:
+            self.add_time(stage, seconds, file, index)
+
+    def report(self, project=''):
+        duration = time.time() - self.start_time
+        with self._lock:
+            docs = sum(stats.get('docs', 0) for stats in self.indices.values())
+            return {
+                'project': project,
+                'start': self.start_time,
+                'duration': duration,
+                'docs': docs,
+                'bytes': sum(stats.get('bytes', 0) for stats in self.indices.values()),
+                'suppressed': sum(stats.get('suppressed', 0) for stats in self.indices.values()),
+                'docs_per_second': docs / duration if duration else 0,
+                'stages': json.loads(json.dumps(self.stages)),
+                'files': json.loads(json.dumps(self.files)),
+                'indices': json.loads(json.dumps(self.indices)),
+            }
+
+    def write_report(self, file_path, project=''):
+        with open(file_path, 'w') as report_file:
+            json.dump(self.report(project), report_file, indent=2, sort_keys=True)
+        LOGGER.info('Wrote run report to: {}'.format(file_path))
+
+    def write_prometheus(self, file_path, project=''):
+        # textfile collector format of the prometheus node exporter
+        report = self.report(project)
+        labels = 'project="{}"'.format(project)
+        lines = [
+            '# HELP scan2elk_run_duration_seconds Duration of the last ingest run',
+            '# TYPE scan2elk_run_duration_seconds gauge',
+            'scan2elk_run_duration_seconds{{{}}} {}'.format(labels, report['duration']),
+            '# HELP scan2elk_last_run_timestamp_seconds Start of the last ingest run',
+            '# TYPE scan2elk_last_run_timestamp_seconds gauge',
+            'scan2elk_last_run_timestamp_seconds{{{}}} {}'.format(labels, report['start']),
+            '# HELP scan2elk_docs_per_second Indexed docs per second of the last ingest run',
+            '# TYPE scan2elk_docs_per_second gauge',
+            'scan2elk_docs_per_second{{{}}} {}'.format(labels, report['docs_per_second']),
+            '# HELP scan2elk_files Parsed files of the last ingest run',
+            '# TYPE scan2elk_files gauge',
+            'scan2elk_files{{{}}} {}'.format(labels, len(report['files'])),
+            '# HELP scan2elk_stage_seconds Time spent per stage in the last ingest run',
+            '# TYPE scan2elk_stage_seconds gauge',
+        ]
+        for stage, stats in sorted(report['stages'].items()):
+            lines.append('scan2elk_stage_seconds{{{},stage="{}"}} {}'.format(labels, stage, stats['seconds']))
+        for name, description in (('docs', 'docs'), ('bytes', 'bytes'), ('bulk_requests', 'bulk requests'),
+                                  ('suppressed', 'duplicate docs not sent')):
+            lines.append('# HELP scan2elk_index_{} Number of {} per index in the last ingest run'.format(
+                name, description))
+            lines.append('# TYPE scan2elk_index_{} gauge'.format(name))
+            for index, stats in sorted(report['indices'].items()):
+                lines.append('scan2elk_index_{}{{{},index="{}"}} {}'.format(name, labels, index, stats.get(name, 0)))
+
+        # write atomically, the node exporter may read the file at any time
+        tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(tmp_path, 'w') as prom_file:
+            prom_file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, file_path)
+
+
+METRICS = Metrics()
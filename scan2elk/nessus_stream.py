@@ -0,0 +1,131 @@
+import logging
+import mmap
+import os
+import re
+import tempfile
+import time
+from copy import deepcopy
+
+from lxml import etree
+from vulnscan_parser.parser.nessus.xml import NessusParserXML
+
+from scan2elk.parse_worker import serialize_results, set_src_file
+
+LOGGER = logging.getLogger(__name__)
+
+REPORT_HOST_RE = re.compile(rb'<ReportHost[\s>]')
+REPORT_END = b'</Report>'
+DOCUMENT_END = b'</Report>\n</NessusClientData_v2>\n'
+
+
+def build_host_document(policy, report, report_host):
+    # minimal .nessus file: policy, report and a single host
+    root = etree.Element('NessusClientData_v2')
+    if policy is not None:
+        root.append(deepcopy(policy))
+    attrib, nsmap = report
+    report_elem = etree.SubElement(root, 'Report', attrib=attrib, nsmap=nsmap)
+    report_elem.append(deepcopy(report_host))
+
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+
+def iter_host_documents(source):
+    """Read a .nessus file (path or file object) incrementally and yield one small document per ReportHost
+
+    Only the policy and the current host are kept in memory.
+    """
+    policy = None
+    report = ({}, {})
+    for event, elem in etree.iterparse(source, events=('start', 'end'), tag=('Policy', 'Report', 'ReportHost'),
+                                       huge_tree=True):
+        if 'start' == event:
+            if 'Report' == elem.tag:
+                report = (dict(elem.attrib), dict(elem.nsmap))
+            continue
+
+        if 'Policy' == elem.tag:
+            policy = deepcopy(elem)
+        elif 'ReportHost' == elem.tag:
+            yield build_host_document(policy, report, elem)
+        # free memory of processed elements
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def iter_nessus_docs(source, add_duplicates=True, src_file=None):
+    """Parse a .nessus file host by host and yield the serialized docs of every host"""
+    if src_file is None:
+        src_file = source
+    with tempfile.TemporaryDirectory(prefix='scan2elk-') as tmp_dir:
+        # keep the file name, only the directory differs
+        tmp_path = os.path.join(tmp_dir, os.path.basename(src_file))
+        for host_document in iter_host_documents(source):
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(host_document)
+            parser = NessusParserXML()
+            parser.add_duplicates = add_duplicates
+            start = time.perf_counter()
+            parser.parse(tmp_path)
+            parsed = time.perf_counter()
+
+            docs = serialize_results(parser)
+            set_src_file(docs, src_file)
+            docs['src_file'] = src_file
+            docs['timings'] = {'parse': parsed - start, 'serialize': time.perf_counter() - parsed}
+            yield docs
+
+
+def split_nessus_file(filepath, shard_size):
+    """Split a .nessus file into byte ranges of whole ReportHost elements with roughly shard_size bytes each
+
+    Returns the end of the header (policy and report start tag) and a list of (start, end) ranges.
+    """
+    with open(filepath, 'rb') as nessus_file:
+        with mmap.mmap(nessus_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets = [match.start() for match in REPORT_HOST_RE.finditer(data)]
+            if not offsets:
+                return 0, []
+            hosts_end = data.rfind(REPORT_END)
+            if hosts_end < offsets[-1]:
+                raise ValueError('Missing Report end tag in file: {}'.format(filepath))
+
+    ranges = []
+    start = offsets[0]
+    for offset in offsets[1:]:
+        if offset - start >= shard_size:
+            ranges.append((start, offset))
+            start = offset
+    ranges.append((start, hosts_end))
+
+    return offsets[0], ranges
+
+
+def parse_nessus_shard(filepath, header_end, start, end, add_duplicates=True):
+    """Parse the ReportHost elements within a byte range of a .nessus file, wrapped with the shared header"""
+    with tempfile.TemporaryDirectory(prefix='scan2elk-') as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, os.path.basename(filepath))
+        with open(filepath, 'rb') as nessus_file, open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(nessus_file.read(header_end))
+            nessus_file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = nessus_file.read(min(remaining, 1024 * 1024))
+                if not block:
+                    break
+                tmp_file.write(block)
+                remaining -= len(block)
+            tmp_file.write(DOCUMENT_END)
+        parser = NessusParserXML()
+        parser.add_duplicates = add_duplicates
+        start = time.perf_counter()
+        parser.parse(tmp_path)
+        parsed = time.perf_counter()
+
+    docs = serialize_results(parser)
+    set_src_file(docs, filepath)
+    docs['src_file'] = filepath
+    docs['timings'] = {'parse': parsed - start, 'serialize': time.perf_counter() - parsed}
+
+    return docs
@@ -1,31 +1,113 @@
 import os
 import logging
-from http.client import HTTPSConnection
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPException, HTTPSConnection
 import getpass
 import json
 import ssl
-from time import sleep
+import threading
+from time import monotonic, sleep
 import tempfile
 
 LOGGER = logging.getLogger(__name__)
 
 
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'scan2elk', 'nessus')
+
+
+class NessusExportCache:
+    """Downloaded .nessus exports of one Nessus server, one file per scan
+
+    The path of a scan does not change with new exports, so an incremental ingest replaces the docs of the previous
+    export. The key of the export (history id and last modification date of the scan) is stored next to it.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+    def path(self, scan_id):
+        return os.path.join(self.cache_dir, 'scan_{}.nessus'.format(scan_id))
+
+    def _key_path(self, scan_id):
+        return '{}.key'.format(self.path(scan_id))
+
+    @staticmethod
+    def _key(history_id, modification_date):
+        return json.dumps({'history_id': history_id, 'last_modification_date': modification_date}, sort_keys=True)
+
+    def get(self, scan_id, history_id, modification_date):
+        file_path = self.path(scan_id)
+        try:
+            with open(self._key_path(scan_id), 'r') as key_file:
+                key = key_file.read()
+        except OSError:
+            return None
+        if key != self._key(history_id, modification_date) or not os.path.isfile(file_path):
+            return None
+
+        return file_path
+
+    def put(self, scan_id, history_id, modification_date, tmp_path):
+        file_path = self.path(scan_id)
+        key_path = self._key_path(scan_id)
+        # never pair a key with the wrong export
+        if os.path.isfile(key_path):
+            os.remove(key_path)
+        os.replace(tmp_path, file_path)
+        with open('{}.tmp'.format(key_path), 'w') as key_file:
+            key_file.write(self._key(history_id, modification_date))
+        os.replace('{}.tmp'.format(key_path), key_path)
+
+        return file_path
+
+
 class NessusAPI:
 
-    def __init__(self, host, port, user, token_path='/tmp/scan2elk-nessus-token'):
-        ssl_context = None
+    # adaptive polling of the export status, in seconds
+    POLL_INITIAL_DELAY = 0.5
+    POLL_MAX_DELAY = 10.0
+    EXPORT_TIMEOUT = 1800
+    DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, host, port, user, token_path='/tmp/scan2elk-nessus-token', max_downloads=4, cache_dir=None):
+        self.host = host
+        self.port = port
+        self._ssl_context = None
         # disable certificate check for localhost only
         if 'localhost' == host:
-            ssl_context = ssl.SSLContext()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-        self.client = HTTPSConnection(host, port, context=ssl_context)
+            self._ssl_context = ssl.SSLContext()
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        # one keep-alive connection per thread
+        self._local = threading.local()
+        self._auth_lock = threading.Lock()
+        self._files_lock = threading.Lock()
+        self.max_downloads = max(1, max_downloads)
         self.user = user
         self._token = ''
         self._token_path = token_path
         self._nessus_files = []
+        # ids of scans which could not be exported or downloaded by iter_exports()
+        self.failed_scans = []
+        # exports of unchanged scans are not downloaded again, scan ids are only unique per server
+        self.cache = NessusExportCache(os.path.join(cache_dir, '{}_{}'.format(host, port))) if cache_dir else None
         self.read_token()
 
+    @property
+    def client(self):
+        try:
+            return self._local.client
+        except AttributeError:
+            self._local.client = HTTPSConnection(self.host, self.port, context=self._ssl_context)
+            return self._local.client
+
+    def _reconnect(self):
+        self.client.close()
+        del self._local.client
+
     @property
     def nessus_file_paths(self):
         return set([nfp.name for nfp in self._nessus_files])
@@ -53,17 +135,17 @@ class NessusAPI:
         if not is_auth_request and not self._token:
             self.authorize()
         # append token if available
-        if self._token:
-            headers['X-Cookie'] = 'token={}'.format(self._token)
+        token = self._token
+        if token:
+            headers['X-Cookie'] = 'token={}'.format(token)
 
-        self.client.request(method, path, params, headers)
-        data = self.client.getresponse().read()
+        data = self._send(method, path, params, headers).read()
         if decode_json:
             data = json.loads(data)
             try:
                 if not is_auth_request and 'Invalid Credentials' == data['error']:
                     LOGGER.info('Credentials are not valid, triggering re-authentication...')
-                    self.authorize()
+                    self.authorize(token)
                     # do request again
                     if not is_nested:
                         LOGGER.info('Repeating request')
@@ -73,7 +155,24 @@ class NessusAPI:
 
         return data
 
-    def authorize(self):
+    def _send(self, method, path, body=None, headers=None):
+        # the server may close idle keep-alive connections, try once more with a new one
+        try:
+            self.client.request(method, path, body, headers or {})
+            return self.client.getresponse()
+        except (HTTPException, ConnectionError):
+            self._reconnect()
+            self.client.request(method, path, body, headers or {})
+            return self.client.getresponse()
+
+    def authorize(self, stale_token=None):
+        with self._auth_lock:
+            # another download thread may have authenticated already
+            if stale_token is not None and stale_token != self._token:
+                return
+            self._authorize()
+
+    def _authorize(self):
         LOGGER.info('Authenticating with user: {}'.format(self.user))
         self._token = ''
         # get password via command line
@@ -88,8 +187,9 @@ class NessusAPI:
         else:
             LOGGER.info('Authentication done. Token: {}...'.format(self._token[0:-10]))
 
-    def get_scan_ids(self, names):
-        scan_ids = set()
+    def get_scans(self, names):
+        # scan id -> scan of the /scans list, including its "last_modification_date"
+        found_scans = {}
         folders = self._do_request('/folders', method='GET')['folders']
         scans = self._do_request('/scans', method='GET')['scans']
 
@@ -98,32 +198,116 @@ class NessusAPI:
                 # get folder name
                 fname = [f for f in folders if f['id'] == scan['folder_id']][0]['name']
                 LOGGER.info('Found nessus scan "{}" in folder "{}"'.format(scan['name'], fname))
-                scan_ids.add(scan['id'])
+                found_scans[scan['id']] = scan
 
-        return scan_ids
+        return found_scans
 
-    def download_exports(self, names):
-        scan_ids = self.get_scan_ids(names)
-        for scan_id in scan_ids:
-            self._do_request('/scans/{}/export/formats?schedule_id={}'.format(scan_id, scan_id), method='GET')
-            file_data = self._do_request('/scans/{}/export'.format(scan_id), {'format': 'nessus'})
-            file_token = file_data['token']
-            # wait up to ~30 seconds for the export to become ready
-            max_tries = 15
-            for i in range(1, max_tries):
-                LOGGER.info('Waiting for export to become ready... (try {}/{})'.format(i, max_tries))
-                status = self._do_request('/tokens/{}/status'.format(file_token), method='GET')
-                if 'ready' == status['status']:
-                    break
-                sleep(1.5)
-            LOGGER.info('Downloading export...')
-            nessus_xml = self._do_request('/tokens/{}/download'.format(file_token), method='GET', decode_json=False)
-            LOGGER.info('Trying to write temporary nessus file')
-            tmp_file = tempfile.NamedTemporaryFile('wb', dir='/tmp', prefix='scan2elk-', suffix='.nessus')
-            tmp_file.write(nessus_xml)
-            LOGGER.info('Wrote to: "{}"'.format(tmp_file.name))
+    def get_scan_ids(self, names):
+        return set(self.get_scans(names).keys())
+
+    def get_history_id(self, scan_id):
+        # latest run of the scan
+        history = self._do_request('/scans/{}'.format(scan_id), method='GET').get('history') or []
+        if not history:
+            return None
+        return max(history, key=lambda entry: entry.get('creation_date', 0)).get('history_id')
+
+    def request_export(self, scan_id, history_id=None):
+        self._do_request('/scans/{}/export/formats?schedule_id={}'.format(scan_id, scan_id), method='GET')
+        path = '/scans/{}/export'.format(scan_id)
+        if history_id is not None:
+            path = '{}?history_id={}'.format(path, history_id)
+        file_data = self._do_request(path, {'format': 'nessus'})
+        return file_data['token']
+
+    def wait_for_export(self, scan_id, file_token):
+        # poll often at first, then back off for large exports
+        delay = self.POLL_INITIAL_DELAY
+        deadline = monotonic() + self.EXPORT_TIMEOUT
+        while True:
+            status = self._do_request('/tokens/{}/status'.format(file_token), method='GET')
+            if 'ready' == status.get('status'):
+                return
+            if monotonic() > deadline:
+                raise TimeoutError('Export of scan {} not ready after {} seconds'.format(scan_id,
+                                                                                       self.EXPORT_TIMEOUT))
+            LOGGER.debug('Waiting {:.1f}s for export of scan {}'.format(delay, scan_id))
+            sleep(delay)
+            delay = min(self.POLL_MAX_DELAY, delay * 1.5)
+
+    def download_export(self, scan_id, file_token, cache_key=None):
+        self.wait_for_export(scan_id, file_token)
+        LOGGER.info('Downloading export of scan {}...'.format(scan_id))
+        headers = {'X-Cookie': 'token={}'.format(self._token)}
+        response = self._send('GET', '/tokens/{}/download'.format(file_token), headers=headers)
+        if 200 != response.status:
+            raise HTTPException('Download of scan {} failed: {} {}'.format(scan_id, response.status,
+                                                                          response.read()[:200]))
+        if self.cache is not None and cache_key is not None:
+            # same file system as the cache, moved into place when complete
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache.cache_dir, prefix='.download-', suffix='.nessus')
+            try:
+                with os.fdopen(fd, 'wb') as cache_file:
+                    self._write_response(response, cache_file)
+                file_path = self.cache.put(*cache_key, tmp_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            LOGGER.info('Wrote export of scan {} to: "{}"'.format(scan_id, file_path))
+            return file_path
+
+        tmp_file = tempfile.NamedTemporaryFile('wb', dir='/tmp', prefix='scan2elk-', suffix='.nessus')
+        self._write_response(response, tmp_file)
+        tmp_file.flush()
+        LOGGER.info('Wrote export of scan {} to: "{}"'.format(scan_id, tmp_file.name))
+        with self._files_lock:
             self._nessus_files.append(tmp_file)
 
+        return tmp_file.name
+
+    def _write_response(self, response, out_file):
+        # write in blocks, the export is never held in memory
+        for block in iter(lambda: response.read(self.DOWNLOAD_BLOCK_SIZE), b''):
+            out_file.write(block)
+
+    def iter_exports(self, names):
+        """Export the scans and yield the paths of the .nessus files as soon as each download is finished
+
+        All exports are requested up front, status polling and downloads run in max_downloads threads. Cached exports
+        of unchanged scans are yielded first. Scans which fail are skipped and listed in failed_scans.
+        """
+        scans = self.get_scans(names)
+        cached_paths = []
+        file_tokens = {}
+        for scan_id, scan in sorted(scans.items()):
+            cache_key = None
+            if self.cache is not None:
+                cache_key = (scan_id, self.get_history_id(scan_id), scan.get('last_modification_date'))
+                cached_path = self.cache.get(*cache_key)
+                if cached_path is not None:
+                    LOGGER.info('Scan {} is unchanged, using cached export: "{}"'.format(scan_id, cached_path))
+                    cached_paths.append(cached_path)
+                    continue
+            file_tokens[scan_id] = (self.request_export(scan_id, cache_key[1] if cache_key else None), cache_key)
+
+        with ThreadPoolExecutor(max_workers=self.max_downloads, thread_name_prefix='nessus-download') as executor:
+            jobs = {executor.submit(self.download_export, scan_id, file_token, cache_key): scan_id
+                    for scan_id, (file_token, cache_key) in file_tokens.items()}
+            yield from cached_paths
+            for job in as_completed(jobs):
+                try:
+                    yield job.result()
+                except (OSError, HTTPException, ValueError, KeyError):
+                    LOGGER.exception('Unable to download export of scan {}'.format(jobs[job]))
+                    self.failed_scans.append(jobs[job])
+        if self.failed_scans:
+            LOGGER.error('Export of scans failed: {}'.format(', '.join(str(scan_id) for scan_id in
+                                                                       sorted(self.failed_scans))))
+
+    def download_exports(self, names):
+        for _ in self.iter_exports(names):
+            pass
+
     def close_tmp_files(self):
         LOGGER.info('Deleting temporary nessus files')
         for nf in self._nessus_files:
@@ -0,0 +1,65 @@
+import logging
+import time
+
+from vulnscan_parser.parser.nessus.xml import NessusParserXML
+from vulnscan_parser.parser.testssl.json import TestsslParserJson
+from vulnscan_parser.parser.sslyze.xml import SslyzeParserXML
+from vulnscan_parser.parser.nmap.xml import NmapParserXML
+from vulnscan_parser.parser.sslscan.xml import SSLScanParserXML
+from vulnscan_parser.parser.pem.text import PemParserText
+from vulnscan_parser.parser.burp.xml import BurpParserXML
+
+LOGGER = logging.getLogger(__name__)
+
+PARSER_CLASSES = {
+    'nmap': NmapParserXML,
+    'nessus': NessusParserXML,
+    'testssl': TestsslParserJson,
+    'sslyze': SslyzeParserXML,
+    'sslscan': SSLScanParserXML,
+    'pem': PemParserText,
+    'burp': BurpParserXML,
+}
+
+# index type -> parser attribute
+RESULT_ATTRIBUTES = {
+    'finding': 'findings',
+    'certificate': 'certificates',
+    'cipher': 'ciphers',
+    'host': 'hosts',
+    'service': 'services',
+}
+
+
+def serialize_results(parser):
+    return {index_type: [entry.to_serializable_dict() for entry in getattr(parser, attr).values()]
+            for index_type, attr in RESULT_ATTRIBUTES.items()}
+
+
+def set_src_file(docs, src_file):
+    # point to the original file instead of a temporary copy
+    for entries in docs.values():
+        for doc in entries:
+            if 'src_file' in doc:
+                doc['src_file'] = src_file
+
+
+def parse_file(tool, filepath, add_duplicates=True, src_file=None):
+    """Parse a single, already validated file in a worker process and return the serialized docs
+
+    A fresh parser is used for every file, so nothing is shared between files. src_file replaces the path of
+    temporary copies, i.e. of archive members.
+    """
+    parser = PARSER_CLASSES[tool]()
+    parser.add_duplicates = add_duplicates
+    start = time.perf_counter()
+    parser.parse(filepath)
+    parsed = time.perf_counter()
+    docs = serialize_results(parser)
+    if src_file is not None:
+        set_src_file(docs, src_file)
+    # for the run report of the main process
+    docs['src_file'] = src_file or filepath
+    docs['timings'] = {'parse': parsed - start, 'serialize': time.perf_counter() - parsed}
+
+    return docs
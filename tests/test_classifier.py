@@ -0,0 +1,50 @@
+import shutil
+import tempfile
+import unittest
+
+from scan2elk.classifier import FileClassifier
+
+BURP_HEADER = b'''<?xml version="1.0"?>
+<!DOCTYPE issues [
+<!ELEMENT issues (issue*)>
+<!ATTLIST issues burpVersion CDATA "">
+<!ATTLIST issues exportTime CDATA "">
+<!ELEMENT issue (serialNumber, type, name, host, path, location, severity, confidence, issueBackground?)>
+<!ELEMENT host (#PCDATA)>
+<!ATTLIST host ip CDATA "">
+]>
+<issues burpVersion="2.1.04" exportTime="Thu Jan 02 10:00:00 CET 2020">
+  <issue>
+'''
+
+
+class FileClassifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = FileClassifier()
+
+    def test_xml_headers(self):
+        self.assertEqual('burp', self.classifier.classify_header(BURP_HEADER))
+        self.assertEqual('nmap', self.classifier.classify_header(
+            b'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE nmaprun>\n<!-- Nmap -->\n<nmaprun scanner="nmap">'))
+        self.assertEqual('nessus', self.classifier.classify_header(
+            b'\xef\xbb\xbf<?xml version="1.0" ?>\n<NessusClientData_v2>\n<Policy>'))
+        self.assertIsNone(self.classifier.classify_header(b'<?xml version="1.0"?>\n<html>'))
+
+    def test_json_headers(self):
+        self.assertEqual('testssl', self.classifier.classify_header(
+            b'[\n {\n  "id": "TLS1_2",\n  "ip": "example.org/10.0.0.1",\n  "severity": "OK",\n  "finding": "offered"'))
+        self.assertIsNone(self.classifier.classify_header(b'{"name": "other"}'))
+
+    def test_unreadable_file(self):
+        # stat works, reading fails
+        tmp_dir = tempfile.mkdtemp(prefix='scan2elk-test-')
+        try:
+            with self.assertLogs('scan2elk.classifier', 'ERROR'):
+                self.assertIsNone(self.classifier.classify(tmp_dir))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if '__main__' == __name__:
+    unittest.main()
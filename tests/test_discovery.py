@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from scan2elk.discovery import FileDiscovery
+
+_isdir = os.path.isdir
+
+
+def slow_isdir(path):
+    # i.e. a network file system, the first directory is scanned before the next one is checked
+    time.sleep(0.05)
+    return _isdir(path)
+
+
+class FileDiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='scan2elk-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_files(self, directory, count):
+        directory = os.path.join(self.root, directory)
+        os.makedirs(directory, exist_ok=True)
+        paths = set()
+        for num in range(count):
+            path = os.path.join(directory, 'file_{}.xml'.format(num))
+            with open(path, 'w') as out:
+                out.write('<nmaprun/>')
+            paths.add(os.path.realpath(path))
+        return paths
+
+    def test_several_directories(self):
+        expected = self.write_files('a', 1) | self.write_files('b', 50) | self.write_files('c/d', 3)
+        directories = [os.path.join(self.root, name) for name in ('a', 'b', 'c')]
+        for _ in range(20):
+            self.assertEqual(expected, set(FileDiscovery(threads=4).iter_files(directories)))
+
+    def test_several_directories_slow_isdir(self):
+        expected = self.write_files('a', 1) | self.write_files('b', 50)
+        directories = [os.path.join(self.root, name) for name in ('a', 'b')]
+        with mock.patch('scan2elk.discovery.os.path.isdir', slow_isdir):
+            self.assertEqual(expected, set(FileDiscovery(threads=4).iter_files(directories)))
+
+    def test_unknown_directories(self):
+        expected = self.write_files('a', 2)
+        directories = [os.path.join(self.root, 'missing'), os.path.join(self.root, 'a')]
+        self.assertEqual(expected, set(FileDiscovery().iter_files(directories)))
+        self.assertEqual(set(), set(FileDiscovery().iter_files([os.path.join(self.root, 'missing')])))
+
+    def test_include_exclude_depth(self):
+        included = self.write_files('nessus', 2)
+        self.write_files('nessus/old', 2)
+        self.write_files('nmap', 2)
+        discovery = FileDiscovery(include=['nessus/'], exclude=['old/'], max_depth=1)
+        self.assertEqual(included, set(discovery.iter_files([self.root])))
+
+
+if '__main__' == __name__:
+    unittest.main()
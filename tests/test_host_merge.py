@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.generate import ScanGenerator
+
+try:
+    from scan2elk.data_handler.data_handler import merge_host_doc
+    from scan2elk.parse_worker import PARSER_CLASSES, parse_file
+except ImportError:
+    PARSER_CLASSES = None
+
+
+def normalize(doc):
+    # the order of array values is not significant for elasticsearch
+    if isinstance(doc, dict):
+        return {key: normalize(value) for key, value in doc.items()}
+    if isinstance(doc, list):
+        return sorted((normalize(value) for value in doc), key=lambda value: json.dumps(value, sort_keys=True))
+    return doc
+
+
+@unittest.skipIf(PARSER_CLASSES is None, 'vulnscan_parser and elasticsearch are required')
+class HostMergeTest(unittest.TestCase):
+    """Hosts found in several files: docs merged from the results of -workers equal the docs of the serial parser"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='scan2elk-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_files(self, tool):
+        # the same hosts with different ports and findings in every directory
+        paths = []
+        for num, generator in enumerate((ScanGenerator(hosts=20, ports=2, findings=3, output_size=32, seed=1),
+                                         ScanGenerator(hosts=20, ports=5, findings=6, output_size=32, seed=2))):
+            out_dir = os.path.join(self.root, str(num))
+            os.makedirs(out_dir, exist_ok=True)
+            paths.extend(getattr(generator, 'write_{}'.format(tool))(out_dir))
+        return paths
+
+    def serial_hosts(self, tool, paths):
+        # like the serial path of scan2elk.py: one parser, hosts are kept across files
+        parser = PARSER_CLASSES[tool]()
+        for path in paths:
+            parser.parse(path)
+            parser.clear_all_but_hosts()
+        docs = [host.to_serializable_dict() for host in parser.hosts.values()]
+        return {doc['id']: doc for doc in docs}
+
+    def worker_hosts(self, tool, paths):
+        # like DocBuffer and the handler: the docs of every file are merged in the order of the files
+        hosts = {}
+        for path in paths:
+            for host in parse_file(tool, path)['host']:
+                hosts[host['id']] = merge_host_doc(hosts[host['id']], host) if host['id'] in hosts else host
+        return hosts
+
+    def assert_same_hosts(self, tool):
+        paths = self.write_files(tool)
+        serial = self.serial_hosts(tool, paths)
+        merged = self.worker_hosts(tool, paths)
+        self.assertTrue(serial)
+        self.assertEqual(sorted(serial), sorted(merged))
+        for host_id, doc in serial.items():
+            self.assertEqual(normalize(doc), normalize(merged[host_id]), 'host {}'.format(host_id))
+
+    def test_nmap(self):
+        self.assert_same_hosts('nmap')
+
+    def test_nessus(self):
+        self.assert_same_hosts('nessus')
+
+    def test_testssl(self):
+        # testssl writes a file per host and port
+        self.assert_same_hosts('testssl')
+
+
+if '__main__' == __name__:
+    unittest.main()